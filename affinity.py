@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Score affinity between linked users, computed over the local score index.
+"""
+
+import numpy as np
+from scipy import sparse
+
+# How many scored titles two users need in common for an affinity.
+MIN_SHARED = 5
+
+# Users whose affinities with everyone are computed at a time.
+BLOCK_SIZE = 256
+
+
+class ScoreMatrix:
+    """Sparse users x media scores, with only the media scored by at least
+    one of the users as columns.
+
+    The transposed matrices are built once, so the affinities of many blocks
+    of users can be computed against them.
+    """
+
+    def __init__(self, user_ids, index):
+        """Builds the matrix from the score index.
+
+        Keyword arguments:
+          user_ids -- AniList user IDs (the matrix rows).
+          index -- ScoreIndex.
+        """
+        rows, media, values = [], [], []
+        for row, user_id in enumerate(user_ids):
+            # Copied, the index may be synced while this runs in an executor.
+            for media_id in list(index.user_media.get(user_id, ())):
+                entry = index.get(media_id, user_id)
+                if entry is not None and entry["score"]:
+                    rows.append(row)
+                    media.append(media_id)
+                    values.append(entry["score"])
+
+        columns, cols = np.unique(np.array(media, dtype=np.int64), return_inverse=True)
+        rows = np.array(rows, dtype=np.int64)
+        self.scores = sparse.csr_matrix(
+            (np.array(values, dtype=np.float64), (rows, cols)),
+            shape=(len(user_ids), len(columns)),
+        )
+        self.mask = self.scores.copy()
+        self.mask.data[:] = 1
+        self.squares = self.scores.multiply(self.scores).tocsr()
+
+        self.scores_t = self.scores.T.tocsr()
+        self.mask_t = self.mask.T.tocsr()
+        self.squares_t = self.squares.T.tocsr()
+
+    def pearson(self, rows, min_shared=MIN_SHARED):
+        """Computes the Pearson correlation of some users with every user over
+        the titles both of them scored.
+
+        Returns a (affinity, shared) tuple of dense rows x users arrays. Pairs
+        with fewer than min_shared titles in common, or no variance, are NaN.
+
+        Keyword arguments:
+          rows -- Rows of the users to correlate.
+          min_shared -- Minimum titles in common.
+        """
+        x = self.scores[rows]
+        m = self.mask[rows]
+
+        shared = (m @ self.mask_t).toarray()
+        sum_x = (x @ self.mask_t).toarray()
+        sum_y = (m @ self.scores_t).toarray()
+        sum_xx = (self.squares[rows] @ self.mask_t).toarray()
+        sum_yy = (m @ self.squares_t).toarray()
+        sum_xy = (x @ self.scores_t).toarray()
+
+        numerator = shared * sum_xy - sum_x * sum_y
+        variance = (shared * sum_xx - sum_x ** 2) * (shared * sum_yy - sum_y ** 2)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            affinity = numerator / np.sqrt(variance)
+        affinity[(shared < min_shared) | ~(variance > 0)] = np.nan
+        return affinity, shared.astype(np.int64)
+
+
+def ranking(user_ids, index, user_id):
+    """Ranks users by their affinity with one user.
+
+    Only that user's row is computed. Returns a list of (user ID, affinity,
+    shared titles) tuples, best first.
+
+    Keyword arguments:
+      user_ids -- AniList user IDs to compare with.
+      index -- ScoreIndex.
+      user_id -- AniList user ID to rank against.
+    """
+    user_ids = list(user_ids)
+    matrix = ScoreMatrix(user_ids, index)
+
+    row = user_ids.index(user_id)
+    affinity, shared = matrix.pearson([row])
+    result = [
+        (other, affinity[0, col], shared[0, col])
+        for col, other in enumerate(user_ids)
+        if col != row and not np.isnan(affinity[0, col])
+    ]
+    return sorted(result, key=lambda i: i[1], reverse=True)
+
+
+def pairs(user_ids, index, count):
+    """Gets the pairs of users with the highest affinity.
+
+    Affinities are computed a block of users at a time, keeping only the best
+    pairs of each block. Returns a list of (user ID, user ID, affinity, shared
+    titles) tuples.
+
+    Keyword arguments:
+      user_ids -- AniList user IDs.
+      index -- ScoreIndex.
+      count -- How many pairs to return.
+    """
+    user_ids = list(user_ids)
+    matrix = ScoreMatrix(user_ids, index)
+
+    best = []
+    for start in range(0, len(user_ids), BLOCK_SIZE):
+        rows = np.arange(start, min(start + BLOCK_SIZE, len(user_ids)))
+        affinity, shared = matrix.pearson(rows)
+        # Each pair once: only users after the row's user.
+        affinity[np.arange(len(user_ids)) <= rows[:, None]] = np.nan
+
+        values = affinity.ravel()
+        valid = np.flatnonzero(~np.isnan(values))
+        if len(valid) > count:
+            valid = valid[np.argpartition(-values[valid], count - 1)[:count]]
+        for i in valid:
+            row, col = divmod(int(i), len(user_ids))
+            best.append(
+                (user_ids[rows[row]], user_ids[col], values[i], shared[row, col])
+            )
+
+    return sorted(best, key=lambda i: i[2], reverse=True)[:count]
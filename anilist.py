@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+Async AniList client.
+
+All requests go through one long-lived pooled keep-alive session so commands
+never block the gateway event loop.
+"""
+
+import asyncio
+import copy
+import json
+import time
+import aiohttp
+from queries import URL
+import ratelimit
+import cache
+import metrics
+import profiling
+import tier
+
+# Connection pool limits.
+POOL_SIZE = 20
+KEEPALIVE_TIMEOUT = 30
+
+# Per-request timeouts (seconds).
+TIMEOUT_TOTAL = 15
+TIMEOUT_CONNECT = 5
+
+# How many times a failed request is retried.
+MAX_RETRIES = 5
+
+session = None
+
+# Requests currently in flight, by cache key.
+inflight = {}
+coalesced = 0
+
+
+class AniListError(Exception):
+    """Raised when AniList returns no usable data."""
+
+    def __init__(self, status, errors=None):
+        super().__init__(f"AniList request failed ({status}): {errors}")
+        self.status = status
+        self.errors = errors
+
+
+async def get_session():
+    """Returns the shared session, creating it on first use."""
+    global session
+
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                total=TIMEOUT_TOTAL, connect=TIMEOUT_CONNECT
+            ),
+            headers={"Content-Type": "application/json", "Accept": "application/json"},
+        )
+    return session
+
+
+async def close():
+    """Closes the shared session."""
+    global session
+
+    if session is not None and not session.closed:
+        await session.close()
+    session = None
+
+
+async def post(
+    query, variables=None, timeout=None, kind=None, priority=ratelimit.INTERACTIVE
+):
+    """Gets the response data of a GraphQL request, from the cache if possible.
+
+    Identical concurrent requests are coalesced into one upstream request,
+    unless the one in flight is of a less urgent priority class.
+
+    Keyword arguments:
+      query -- GraphQL query document.
+      variables -- Query variables.
+      timeout -- Total timeout override (seconds).
+      kind -- Entity type used for caching (see cache.TTLS), None to skip it.
+      priority -- Rate limit priority class (see ratelimit.PRIORITIES).
+    """
+    global coalesced
+
+    key = cache.make_key(query, variables)
+    if kind is not None:
+        data = cache.responses.get(key)
+        if data is not None:
+            return data
+
+    flight = inflight.get(key)
+    if flight is None or ratelimit.more_urgent(priority, flight["priority"]):
+        # Someone waiting on a command doesn't queue behind a prefetch.
+        flight = {
+            "task": asyncio.ensure_future(
+                fetch(query, variables, timeout, kind, key, priority)
+            ),
+            "waiters": 0,
+            "priority": priority,
+        }
+        inflight[key] = flight
+
+        def land(_, flight=flight):
+            if inflight.get(key) is flight:
+                del inflight[key]
+
+        flight["task"].add_done_callback(land)
+    else:
+        coalesced += 1
+    flight["waiters"] += 1
+
+    data = await asyncio.shield(flight["task"])
+
+    # Callers modify the data they get, so a shared response is copied.
+    if flight["waiters"] > 1:
+        return copy.deepcopy(data)
+    return data
+
+
+async def fetch(query, variables, timeout, kind, key, priority):
+    """Sends a request and caches its response data.
+
+    Responses are looked up in and stored to the shared tier too, when the
+    bot runs as several processes.
+
+    Keyword arguments:
+      query -- GraphQL query document.
+      variables -- Query variables.
+      timeout -- Total timeout override (seconds).
+      kind -- Entity type used for caching, None to skip it.
+      key -- Cache key of the request.
+      priority -- Rate limit priority class.
+    """
+    if kind is not None:
+        data = await tier.get(key)
+        if data is not None:
+            cache.responses.set(key, data, cache.TTLS[kind])
+            return data
+
+    data = await send(query, variables, timeout, priority)
+    if kind is not None and any(value is not None for value in data.values()):
+        cache.responses.set(key, data, cache.TTLS[kind])
+        tier.store(key, data, cache.TTLS[kind])
+    return data
+
+
+async def send(query, variables=None, timeout=None, priority=ratelimit.INTERACTIVE):
+    """Sends a GraphQL request to AniList and returns the response data.
+
+    Every request waits for the shared rate limiter. Rate limited, server side
+    and network failures are retried with jittered backoff.
+
+    Keyword arguments:
+      query -- GraphQL query document.
+      variables -- Query variables.
+      timeout -- Total timeout override (seconds).
+      priority -- Rate limit priority class (see ratelimit.PRIORITIES).
+    """
+    http = await get_session()
+    kwargs = {}
+    if timeout is not None:
+        kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+    name = metrics.query_name(query)
+
+    for attempt in range(MAX_RETRIES + 1):
+        queued = time.monotonic()
+        metrics.ratelimit_queue.inc(priority=priority)
+        try:
+            with profiling.span("ratelimit"):
+                await ratelimit.limiter.acquire(priority)
+        finally:
+            metrics.ratelimit_queue.inc(-1, priority=priority)
+        metrics.ratelimit_wait.observe(time.monotonic() - queued, priority=priority)
+        start = time.monotonic()
+        try:
+            with profiling.span("network"):
+                async with http.post(
+                    URL, json={"query": query, "variables": variables or {}}, **kwargs
+                ) as response:
+                    ratelimit.limiter.update(response.headers)
+                    status = response.status
+                    raw = await response.read()
+            with profiling.span("decode"):
+                body = json.loads(raw) if raw.strip() else None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            metrics.anilist_seconds.observe(time.monotonic() - start, query=name)
+            metrics.anilist_requests.inc(query=name, status=type(e).__name__)
+            if attempt == MAX_RETRIES:
+                # Malformed responses fail like any other upstream failure.
+                if isinstance(e, ValueError):
+                    raise AniListError(status, f"undecodable response: {e}") from e
+                raise
+            print(f"AniList request failed ({e!r}), retrying.")
+            await asyncio.sleep(ratelimit.backoff(attempt))
+            continue
+        metrics.anilist_seconds.observe(time.monotonic() - start, query=name)
+        metrics.anilist_requests.inc(query=name, status=status)
+
+        if status == 429 or status >= 500:
+            if attempt == MAX_RETRIES:
+                break
+            # The limiter already blocks for Retry-After on 429s.
+            await asyncio.sleep(ratelimit.backoff(attempt))
+            continue
+
+        # AniList answers "not found" with a 404 and null data, which callers
+        # treat as a regular empty result.
+        if body is None or body.get("data") is None:
+            raise AniListError(status, body and body.get("errors"))
+        return body["data"]
+
+    raise AniListError(status, body and body.get("errors"))
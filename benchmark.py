@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+"""
+Offline command benchmark against a local fake AniList (fakeanilist.py).
+
+Starts the fake server, links synthetic users in a scratch database, calls
+the command handlers with fake contexts at the given concurrency and
+reports latency percentiles and upstream requests per command:
+
+    python benchmark.py --iterations 50 --concurrency 8 --latency 0.08
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakeanilist
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Discord IDs of the benchmark guild and its first linked member.
+GUILD_ID = 1000
+MEMBER_ID = 2000
+
+# Commands benchmarked by default, in order.
+COMMANDS = (
+    "anime",
+    "manga",
+    "character",
+    "user",
+    "favourites",
+    "search",
+    "score",
+    "scores",
+    "top",
+    "seasonal",
+    "affinity",
+    "recommend",
+)
+
+
+class FakeMessage:
+    """Sent message. Reactions and edits are ignored."""
+
+    def __init__(self, content=None, embed=None):
+        self.content = content
+        self.embed = embed
+
+    async def add_reaction(self, emoji):
+        pass
+
+    async def remove_reaction(self, emoji, member):
+        pass
+
+    async def edit(self, content=None, embed=None):
+        pass
+
+
+class FakeAuthor:
+    def __init__(self, id):
+        self.id = id
+        self.name = f"member{id}"
+        self.display_name = self.name
+
+
+class FakeGuild:
+    def __init__(self, id):
+        self.id = id
+        self.channels = []
+
+
+class FakeContext:
+    """Just enough of a commands.Context for the command handlers."""
+
+    def __init__(self, guild_id, author_id):
+        self.guild = FakeGuild(guild_id)
+        self.author = FakeAuthor(author_id)
+        self.message = FakeMessage()
+        self.message.guild = self.guild
+        self.message.author = self.author
+        self.channel = self
+        self.sent = []
+
+    async def send(self, content=None, embed=None):
+        message = FakeMessage(content, embed)
+        self.sent.append(message)
+        return message
+
+
+def command_args(command, world, linked, rng, distinct):
+    """Gets the arguments of one command call.
+
+    Keyword arguments:
+      command -- Command name.
+      world -- Synthetic catalogue served by the fake server.
+      linked -- AniList IDs of the linked users.
+      rng -- Random generator.
+      distinct -- How many different titles / users are asked for.
+    """
+    anime = [world.media[i] for i in range(1, 2 * distinct, 2)]
+    manga = [world.media[i] for i in range(2, 2 * distinct + 1, 2)]
+    characters = [world.characters[i] for i in range(1, distinct + 1)]
+    user = world.users[rng.choice(linked[:distinct])]["name"]
+
+    def title(media):
+        return media["title"]["romaji"].split()
+
+    if command == "anime":
+        return title(rng.choice(anime))
+    if command == "manga":
+        return title(rng.choice(manga))
+    if command == "character":
+        return rng.choice(characters)["name"]["full"].split()
+    if command in ("user", "favourites", "recommend"):
+        return [user]
+    if command == "search":
+        return ["anime", rng.choice(fakeanilist.WORDS)]
+    if command == "score":
+        return [user] + title(rng.choice(anime))
+    if command == "scores":
+        return ["anime"] + title(rng.choice(anime))
+    if command == "top":
+        return ["50", user]
+    if command == "seasonal":
+        return [rng.choice(fakeanilist.SEASONS), str(rng.randint(2000, 2024))]
+    if command == "affinity":
+        return ["all"] if rng.random() < 0.5 else [user]
+    raise ValueError(f"Unknown command {command}")
+
+
+def percentile(values, fraction):
+    """Gets a percentile of some values (nearest rank)."""
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_server(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("The fake AniList server did not start.")
+
+
+def upstream_requests(metrics):
+    """Gets the number of AniList requests sent so far."""
+    return sum(metrics.anilist_requests.values.values())
+
+
+async def run_command(main, metrics, name, calls, concurrency):
+    """Runs calls of a command and returns (latencies, errors, requests).
+
+    Keyword arguments:
+      main -- Bot module.
+      metrics -- Metrics module.
+      name -- Command name.
+      calls -- Argument lists.
+      concurrency -- How many calls run at the same time.
+    """
+    command = main.bot.get_command(name)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def call(args):
+        async with semaphore:
+            ctx = FakeContext(GUILD_ID, MEMBER_ID)
+            start = time.perf_counter()
+            try:
+                await command.callback(ctx, *args)
+            except Exception as e:
+                errors.append(e)
+            latencies.append(time.perf_counter() - start)
+
+    before = upstream_requests(metrics)
+    await asyncio.gather(*(call(args) for args in calls))
+    return latencies, errors, upstream_requests(metrics) - before
+
+
+async def benchmark(args, world):
+    """Runs the benchmark against a started fake server."""
+    import files
+
+    linked = list(range(1, args.linked + 1))
+    for i, user_id in enumerate(linked):
+        files.add_link(
+            GUILD_ID,
+            MEMBER_ID + i,
+            {
+                "name": world.users[user_id]["name"],
+                "id": user_id,
+                "displayName": f"member{MEMBER_ID + i}",
+            },
+        )
+
+    import anilist
+    import main
+    import metrics
+    import ratelimit
+    import scoreindex
+    import titleindex
+
+    anilist.URL = f"http://127.0.0.1:{args.port}/"
+    if not args.rate_limit:
+        # Without a server side limit, the client side budget isn't measured either.
+        ratelimit.limiter.limit = ratelimit.limiter.tokens = 10 ** 9
+
+    async def no_reactions(*_, **__):
+        raise asyncio.TimeoutError
+
+    # Paginated commands wait for reactions, which never come here.
+    main.bot.wait_for = no_reactions
+
+    start = time.perf_counter()
+    before = upstream_requests(metrics)
+    await scoreindex.sync(linked)
+    main.recommender.update()
+    print(
+        f"List sync of {len(linked)} users: {time.perf_counter() - start:.2f}s, "
+        f"{upstream_requests(metrics) - before} requests"
+    )
+
+    if args.title_index:
+        start = time.perf_counter()
+        before = upstream_requests(metrics)
+        while not titleindex.index.complete:
+            await titleindex.crawl()
+        print(
+            f"Title index crawl of {titleindex.index.stats()['media']} media: "
+            f"{time.perf_counter() - start:.2f}s, "
+            f"{upstream_requests(metrics) - before} requests"
+        )
+
+    rng = random.Random(args.seed)
+    header = f"{'command':<12}{'calls':>6}{'errors':>7}{'p50 ms':>9}{'p95 ms':>9}"
+    header += f"{'p99 ms':>9}{'max ms':>9}{'requests':>10}{'req/call':>9}"
+    print(header)
+    for name in args.commands:
+        if args.cold:
+            main.cache.responses.clear()
+            main.resolver.names.clear()
+            main.embeds.rendered.clear()
+
+        calls = [
+            command_args(name, world, linked, rng, args.distinct)
+            for _ in range(args.iterations)
+        ]
+        latencies, errors, requests = await run_command(
+            main, metrics, name, calls, args.concurrency
+        )
+        ms = [i * 1000 for i in latencies]
+        print(
+            f"{name:<12}{len(ms):>6}{len(errors):>7}"
+            f"{percentile(ms, 0.5):>9.1f}{percentile(ms, 0.95):>9.1f}"
+            f"{percentile(ms, 0.99):>9.1f}{max(ms):>9.1f}"
+            f"{requests:>10}{requests / len(ms):>9.2f}"
+        )
+        for error in errors[:3]:
+            print(f"  {error!r}")
+
+    await anilist.close()
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("commands", nargs="*", default=COMMANDS)
+    parser.add_argument("--iterations", type=int, default=20, help="calls per command")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--distinct", type=int, default=10, help="different titles / users asked for"
+    )
+    parser.add_argument("--linked", type=int, default=50, help="linked users")
+    parser.add_argument(
+        "--cold", action="store_true", help="clear memory caches before each command"
+    )
+    parser.add_argument(
+        "--title-index",
+        action="store_true",
+        help="crawl the catalogue into the local title index first",
+    )
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="seconds")
+    parser.add_argument(
+        "--rate-limit", type=int, default=0, help="requests per minute, 0 for none"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--media", type=int, default=2000)
+    parser.add_argument("--characters", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--entries", type=int, default=150, help="per user")
+    return parser.parse_args(args)
+
+
+def run():
+    args = parse_args()
+    args.port = free_port()
+    world = fakeanilist.World(
+        args.seed, args.media, args.characters, args.users, args.entries
+    )
+
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "fakeanilist.py")]
+        + ["--port", str(args.port), "--seed", str(args.seed)]
+        + ["--latency", str(args.latency), "--jitter", str(args.jitter)]
+        + ["--rate-limit", str(args.rate_limit), "--media", str(args.media)]
+        + ["--characters", str(args.characters), "--users", str(args.users)]
+        + ["--entries", str(args.entries)]
+    )
+
+    # The bot keeps its databases and settings in the working directory.
+    cwd = os.getcwd()
+    workdir = tempfile.TemporaryDirectory(prefix="anichan-bench-")
+    os.chdir(workdir.name)
+    with open("config.json", "w") as settings_file:
+        settings_file.write('{"prefix": "-", "metrics_port": null, "servers": {}}')
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(wait_for_server(args.port))
+        loop.run_until_complete(benchmark(args, world))
+    finally:
+        server.terminate()
+        server.wait()
+        os.chdir(cwd)
+        workdir.cleanup()
+
+
+if __name__ == "__main__":
+    run()
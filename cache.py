@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""
+In-process AniList response cache.
+"""
+
+import json
+import re
+import time
+from collections import OrderedDict
+
+# How long responses of each entity type stay fresh (seconds).
+TTLS = {
+    "media": 6 * 60 * 60,
+    "character": 6 * 60 * 60,
+    "search": 60 * 60,
+    "seasonal": 60 * 60,
+    "user": 5 * 60,
+    "medialist": 60,
+}
+
+MAX_ENTRIES = 5000
+MAX_BYTES = 32 * 1024 * 1024
+
+
+class TTLCache:
+    """LRU cache with per-entry expiry, bounded by entry count and size.
+
+    Values are stored serialized, so every hit returns a fresh copy that
+    callers are free to modify.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Returns a cached value, or None if missing or expired.
+
+        Keyword arguments:
+          key -- Cache key.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires, payload = entry
+        if expires <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return json.loads(payload)
+
+    def peek(self, key):
+        """Returns a cached value, or None if missing or expired, without
+        counting a lookup or refreshing its recency.
+
+        Keyword arguments:
+          key -- Cache key.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return json.loads(entry[1])
+
+    def set(self, key, value, ttl):
+        """Stores a value.
+
+        Keyword arguments:
+          key -- Cache key.
+          value -- JSON serializable value.
+          ttl -- Time to live (seconds).
+        """
+        payload = json.dumps(value, separators=(",", ":"))
+        if len(payload) > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + ttl, payload)
+        self.size += len(payload)
+
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, payload = self.entries.pop(key)
+        self.size -= len(payload)
+
+    def clear(self):
+        """Removes all entries."""
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        """Returns the cache counters."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def make_key(query, variables):
+    """Builds a cache key from a query and its variables.
+
+    Keyword arguments:
+      query -- GraphQL query document.
+      variables -- Query variables.
+    """
+    query = re.sub(r"\s+", " ", query).strip()
+    return query + json.dumps(variables or {}, sort_keys=True, separators=(",", ":"))
+
+
+def lookup(query, variables):
+    """Gets the cached response data of a request.
+
+    Keyword arguments:
+      query -- GraphQL query document.
+      variables -- Query variables.
+    """
+    return responses.get(make_key(query, variables))
+
+
+def store(query, variables, data, kind):
+    """Caches the response data of a request.
+
+    Keyword arguments:
+      query -- GraphQL query document.
+      variables -- Query variables.
+      data -- Response data.
+      kind -- Entity type (see TTLS).
+    """
+    responses.set(make_key(query, variables), data, TTLS[kind])
+
+
+responses = TTLCache()
@@ -1 +1 @@
-{"prefix": "-", "servers": {}}
+{"prefix": "-", "metrics_port": 9108, "lean_intents": false, "servers": {}}
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+"""
+Persistent AniList metadata cache that survives restarts.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+CACHE_FILE = "cache.db"
+
+# Entries older than this are refreshed in the background when read (seconds).
+STALE_AFTER = 6 * 60 * 60
+# Entries older than this, and the oldest entries past MAX_ROWS, are removed
+# when compacting.
+MAX_AGE = 30 * 24 * 60 * 60
+MAX_ROWS = 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    kind TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (kind, id)
+);
+CREATE INDEX IF NOT EXISTS entities_fetched_at ON entities (fetched_at);
+CREATE TABLE IF NOT EXISTS names (
+    key TEXT PRIMARY KEY,
+    id INTEGER NOT NULL,
+    resolved_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS titles (
+    id INTEGER PRIMARY KEY,
+    payload TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS titles_updated_at ON titles (updated_at);
+CREATE TABLE IF NOT EXISTS crawls (
+    name TEXT PRIMARY KEY,
+    cursor INTEGER NOT NULL,
+    finished_at REAL
+);
+"""
+
+# Title index names and their trigram index. FTS5's trigram tokenizer needs
+# SQLite 3.34 or later, so these are only created where it's available.
+TITLE_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS title_trigrams USING fts5(
+    name, content='title_names', content_rowid='id', tokenize='trigram'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS title_trigram_counts
+USING fts5vocab(title_trigrams, 'row');
+CREATE TABLE IF NOT EXISTS title_names (
+    id INTEGER PRIMARY KEY,
+    media_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    popularity INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS title_names_media_id ON title_names (media_id);
+CREATE INDEX IF NOT EXISTS title_names_name ON title_names (name);
+CREATE TRIGGER IF NOT EXISTS title_names_insert AFTER INSERT ON title_names BEGIN
+    INSERT INTO title_trigrams (rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS title_names_delete AFTER DELETE ON title_names BEGIN
+    INSERT INTO title_trigrams (title_trigrams, rowid, name)
+    VALUES ('delete', old.id, old.name);
+END;
+"""
+
+connection = None
+# Whether the title index tables could be created, known after connecting.
+title_index = None
+# Connections of executor threads, which can't share the main one.
+readers = threading.local()
+
+
+def connect():
+    """Opens a connection to the cache database, creating it if needed."""
+    global title_index
+
+    db = sqlite3.connect(CACHE_FILE)
+    db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    if title_index is not False:
+        try:
+            db.executescript(TITLE_SCHEMA)
+            title_index = True
+        except sqlite3.OperationalError as e:
+            print(f"No title index, SQLite {sqlite3.sqlite_version} lacks it: {e}")
+            title_index = False
+    return db
+
+
+def get_connection():
+    """Gets the shared cache database connection."""
+    global connection
+
+    if connection is None:
+        connection = connect()
+    return connection
+
+
+def get_reader():
+    """Gets this thread's own cache database connection, for lookups run in an
+    executor."""
+    db = getattr(readers, "connection", None)
+    if db is None:
+        db = readers.connection = connect()
+    return db
+
+
+def has_title_index():
+    """Checks whether this SQLite can keep the title index (FTS5 with the
+    trigram tokenizer)."""
+    get_connection()
+    return title_index
+
+
+def get(kind, id):
+    """Gets a stored entity.
+
+    Returns a (payload, fetched_at) tuple, or None if it is not stored.
+
+    Keyword arguments:
+      kind -- Entity kind.
+      id -- AniList ID.
+    """
+    row = (
+        get_connection()
+        .execute(
+            "SELECT payload, fetched_at FROM entities WHERE kind = ? AND id = ?",
+            (kind, id),
+        )
+        .fetchone()
+    )
+    if row is None:
+        return None
+    return json.loads(row[0]), row[1]
+
+
+def put(kind, id, payload):
+    """Stores an entity.
+
+    Keyword arguments:
+      kind -- Entity kind.
+      id -- AniList ID.
+      payload -- Entity dictionary.
+    """
+    db = get_connection()
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO entities (kind, id, payload, fetched_at)"
+            " VALUES (?, ?, ?, ?)",
+            (kind, id, json.dumps(payload, separators=(",", ":")), time.time()),
+        )
+
+
+def is_stale(fetched_at):
+    """Checks whether an entity should be refreshed.
+
+    Keyword arguments:
+      fetched_at -- When the entity was fetched (unix time).
+    """
+    return time.time() - fetched_at > STALE_AFTER
+
+
+def get_name(key):
+    """Gets the ID a name resolved to, or None.
+
+    Keyword arguments:
+      key -- Normalized name key.
+    """
+    row = (
+        get_connection()
+        .execute(
+            "SELECT id FROM names WHERE key = ? AND resolved_at > ?",
+            (key, time.time() - MAX_AGE),
+        )
+        .fetchone()
+    )
+    return row[0] if row else None
+
+
+def put_name(key, id):
+    """Stores the ID a name resolved to.
+
+    Keyword arguments:
+      key -- Normalized name key.
+      id -- AniList ID.
+    """
+    db = get_connection()
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO names (key, id, resolved_at) VALUES (?, ?, ?)",
+            (key, id, time.time()),
+        )
+
+
+def get_titles(ids):
+    """Gets stored title index records.
+
+    Returns a dictionary of media ID to record.
+
+    Keyword arguments:
+      ids -- Media IDs.
+    """
+    ids = list(ids)
+    return {
+        id: json.loads(payload)
+        for id, payload in get_reader().execute(
+            f"SELECT id, payload FROM titles WHERE id IN ({','.join('?' * len(ids))})",
+            ids,
+        )
+    }
+
+
+def put_titles(records, names):
+    """Stores title index records and replaces the names of their media.
+
+    Keyword arguments:
+      records -- Record dictionaries.
+      names -- (media ID, normalized name, media type, popularity) tuples.
+    """
+    db = get_connection()
+    now = time.time()
+    with db:
+        db.executemany(
+            "INSERT OR REPLACE INTO titles (id, payload, updated_at) VALUES (?, ?, ?)",
+            [
+                (record["id"], json.dumps(record, separators=(",", ":")), now)
+                for record in records
+            ],
+        )
+        db.executemany(
+            "DELETE FROM title_names WHERE media_id = ?",
+            [(record["id"],) for record in records],
+        )
+        db.executemany(
+            "INSERT INTO title_names (media_id, name, type, popularity)"
+            " VALUES (?, ?, ?, ?)",
+            names,
+        )
+
+
+def get_title_ids(name, media_type=None):
+    """Gets the media with a name.
+
+    Returns a list of (media ID, popularity) tuples.
+
+    Keyword arguments:
+      name -- Normalized name.
+      media_type -- Media type, None for all.
+    """
+    return (
+        get_reader()
+        .execute(
+            "SELECT media_id, popularity FROM title_names"
+            " WHERE name = :name AND (:type IS NULL OR type = :type)",
+            {"name": name, "type": media_type},
+        )
+        .fetchall()
+    )
+
+
+def _find_title_names(where, order, value, media_type, limit):
+    return (
+        get_reader()
+        .execute(
+            "SELECT n.name, n.media_id, n.popularity FROM title_trigrams t"
+            " JOIN title_names n ON n.id = t.rowid"
+            f" WHERE {where} AND (:type IS NULL OR n.type = :type)"
+            f" ORDER BY {order} LIMIT :limit",
+            {"value": value, "type": media_type, "limit": limit},
+        )
+        .fetchall()
+    )
+
+
+def like_title_names(pattern, media_type=None, limit=100):
+    """Gets the names LIKE a pattern, most popular first.
+
+    Returns a list of (name, media ID, popularity) tuples.
+
+    Keyword arguments:
+      pattern -- LIKE pattern.
+      media_type -- Media type, None for all.
+      limit -- Most names returned.
+    """
+    return _find_title_names(
+        "t.name LIKE :value", "n.popularity DESC", pattern, media_type, limit
+    )
+
+
+def match_title_names(query, media_type=None, limit=100):
+    """Gets the names matching a trigram index query, best ranked first.
+
+    Returns a list of (name, media ID, popularity) tuples.
+
+    Keyword arguments:
+      query -- FTS5 query.
+      media_type -- Media type, None for all.
+      limit -- Most names returned.
+    """
+    return _find_title_names(
+        "title_trigrams MATCH :value", "t.rank", query, media_type, limit
+    )
+
+
+def count_trigrams(trigrams):
+    """Gets how many names contain each of some trigrams.
+
+    Returns a dictionary of trigram to name count, without the trigrams no
+    name contains.
+
+    Keyword arguments:
+      trigrams -- Trigrams.
+    """
+    trigrams = list(trigrams)
+    return dict(
+        get_reader().execute(
+            "SELECT term, doc FROM title_trigram_counts"
+            f" WHERE term IN ({','.join('?' * len(trigrams))})",
+            trigrams,
+        )
+    )
+
+
+def count_titles():
+    """Returns a (media, names) tuple of title index counts."""
+    db = get_connection()
+    return (
+        db.execute("SELECT COUNT(*) FROM titles").fetchone()[0],
+        db.execute("SELECT COUNT(*) FROM title_names").fetchone()[0],
+    )
+
+
+def get_crawl(name):
+    """Gets the progress of a crawl.
+
+    Returns a (cursor, finished_at) tuple, (0, None) if it never ran.
+
+    Keyword arguments:
+      name -- Crawl name.
+    """
+    row = (
+        get_connection()
+        .execute("SELECT cursor, finished_at FROM crawls WHERE name = ?", (name,))
+        .fetchone()
+    )
+    return tuple(row) if row else (0, None)
+
+
+def put_crawl(name, cursor, finished_at):
+    """Stores the progress of a crawl.
+
+    Keyword arguments:
+      name -- Crawl name.
+      cursor -- Last crawled ID, 0 to start over.
+      finished_at -- When the last full pass finished (unix time), or None.
+    """
+    db = get_connection()
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO crawls (name, cursor, finished_at)"
+            " VALUES (?, ?, ?)",
+            (name, cursor, finished_at),
+        )
+
+
+def compact():
+    """Removes old and excess entries and returns their space to the OS.
+
+    Uses its own connection so it can run in an executor thread.
+    """
+    db = connect()
+    try:
+        with db:
+            oldest = time.time() - MAX_AGE
+            db.execute("DELETE FROM entities WHERE fetched_at < ?", (oldest,))
+            db.execute("DELETE FROM names WHERE resolved_at < ?", (oldest,))
+            db.execute(
+                "DELETE FROM entities WHERE rowid IN (SELECT rowid FROM entities"
+                " ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+                (MAX_ROWS,),
+            )
+        db.execute("PRAGMA incremental_vacuum").fetchall()
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        db.close()
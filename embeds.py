@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+"""
+Cache of rendered embeds for entity cards.
+"""
+
+import json
+import zlib
+import discord
+from cache import TTLCache
+import profiling
+
+# How long rendered embeds are kept (seconds).
+RENDER_TTL = 6 * 60 * 60
+
+rendered = TTLCache(max_entries=2000, max_bytes=8 * 1024 * 1024)
+
+
+def version(entity):
+    """Gets the version of an entity's payload.
+
+    A refetched entity with any changed field gets a new version, so its old
+    rendering is not used.
+
+    Keyword arguments:
+      entity -- Entity dictionary.
+    """
+    payload = json.dumps(entity, sort_keys=True, separators=(",", ":"))
+    return zlib.crc32(payload.encode())
+
+
+def render(namespace, entity, build):
+    """Gets the embed of an entity, building it only if it was not rendered.
+
+    Keyword arguments:
+      namespace -- Entity namespace (e.g. "Media:ANIME").
+      entity -- Entity dictionary.
+      build -- Function building the embed from the entity. It may modify it.
+    """
+    key = f'{namespace}:{entity["id"]}:{version(entity):08x}'
+    payload = rendered.get(key)
+    if payload is None:
+        with profiling.span("render"):
+            payload = build(entity).to_dict()
+        rendered.set(key, payload, RENDER_TTL)
+    return discord.Embed.from_dict(payload)
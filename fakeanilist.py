@@ -0,0 +1,618 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the AniList GraphQL API, serving synthetic data.
+
+It understands the subset of GraphQL the bot's queries use (aliases,
+arguments, variables and @include) and answers them from a generated
+catalogue, with configurable latency and rate limiting. Used by the
+benchmark, it can also be run on its own:
+
+    python fakeanilist.py --port 8765 --latency 0.08
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from aiohttp import web
+
+STATUSES = ("CURRENT", "COMPLETED", "PAUSED", "DROPPED", "PLANNING", "REPEATING")
+SEASONS = ("WINTER", "SPRING", "SUMMER", "FALL")
+GENRES = (
+    "Action",
+    "Adventure",
+    "Comedy",
+    "Drama",
+    "Fantasy",
+    "Horror",
+    "Mystery",
+    "Romance",
+    "Sci-Fi",
+    "Slice of Life",
+    "Sports",
+    "Supernatural",
+    "Thriller",
+)
+FORMATS = {"ANIME": ("TV", "MOVIE", "OVA", "ONA"), "MANGA": ("MANGA", "ONE_SHOT")}
+WORDS = (
+    "blue",
+    "sky",
+    "sword",
+    "academy",
+    "hero",
+    "night",
+    "spring",
+    "dragon",
+    "letter",
+    "garden",
+    "moon",
+    "station",
+    "tale",
+    "summer",
+    "ghost",
+    "star",
+    "river",
+    "princess",
+    "machine",
+    "winter",
+    "café",
+    "rain",
+    "orbit",
+    "fox",
+)
+COLORS = ("blue", "purple", "pink", "orange", "red", "green", "gray")
+
+TOKEN = re.compile(
+    r'\s+|,|#[^\n]*|(?P<string>"(?:[^"\\]|\\.)*")|(?P<number>-?\d+(?:\.\d+)?)'
+    r"|(?P<name>[_A-Za-z][_0-9A-Za-z]*)|(?P<punct>[{}():\[\]!$@=])"
+)
+
+
+class World:
+    """Synthetic AniList catalogue: media, characters, users and their lists.
+
+    The same seed always generates the same catalogue.
+    """
+
+    def __init__(
+        self, seed=1, media=2000, characters=1000, users=500, entries_per_user=150
+    ):
+        rng = random.Random(seed)
+        self.media = {}
+        self.characters = {}
+        self.users = {}
+        self.lists = {}
+
+        for media_id in range(1, media + 1):
+            type = "ANIME" if media_id % 2 else "MANGA"
+            words = rng.sample(WORDS, 3)
+            romaji = f"{' '.join(words).title()} {media_id}"
+            self.media[media_id] = {
+                "id": media_id,
+                "type": type,
+                "title": {
+                    "english": romaji.upper() if rng.random() < 0.7 else None,
+                    "romaji": romaji,
+                    "native": f"ネイティブ{media_id}",
+                },
+                "description": "<p>"
+                + " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 160)))
+                + "<br><i>(Source: synthetic)</i></p>",
+                "meanScore": rng.randint(40, 90),
+                "coverImage": {"extraLarge": f"https://img.example/cover/{media_id}"},
+                "bannerImage": (
+                    f"https://img.example/banner/{media_id}"
+                    if rng.random() < 0.5
+                    else None
+                ),
+                "siteUrl": f"https://anilist.co/{type.lower()}/{media_id}",
+                "genres": rng.sample(GENRES, rng.randint(0, 4)),
+                "status": rng.choice(("FINISHED", "RELEASING", "NOT_YET_RELEASED")),
+                "format": rng.choice(FORMATS[type]),
+                "season": rng.choice(SEASONS) if type == "ANIME" else None,
+                "seasonYear": rng.randint(2000, 2024) if type == "ANIME" else None,
+                "episodes": rng.randint(1, 50) if type == "ANIME" else None,
+                "duration": rng.randint(5, 120) if type == "ANIME" else None,
+                "chapters": rng.randint(1, 300) if type == "MANGA" else None,
+                "volumes": rng.randint(1, 30) if type == "MANGA" else None,
+                "popularity": rng.randint(100, 500000),
+                "favourites": rng.randint(0, 50000),
+            }
+
+        media_ids = list(self.media)
+        for character_id in range(1, characters + 1):
+            name = f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()}"
+            self.characters[character_id] = {
+                "id": character_id,
+                "name": {
+                    "full": f"{name} {character_id}",
+                    "native": f"キャラ{character_id}",
+                    "alternative": [rng.choice(WORDS).title()],
+                },
+                "image": {"large": f"https://img.example/character/{character_id}"},
+                "description": " ".join(rng.choice(WORDS) for _ in range(60))
+                + " ~!a spoiler!~",
+                "gender": rng.choice(("Female", "Male", None)),
+                "dateOfBirth": {"year": None, "month": rng.randint(1, 12), "day": 1},
+                "age": str(rng.randint(10, 40)),
+                "siteUrl": f"https://anilist.co/character/{character_id}",
+                "media": {
+                    "edges": [
+                        {
+                            "relationType": None,
+                            "characterRole": rng.choice(("MAIN", "SUPPORTING")),
+                            "node": self.media[media_id],
+                        }
+                        for media_id in rng.sample(media_ids, rng.randint(1, 6))
+                    ]
+                },
+                "favourites": rng.randint(0, 20000),
+            }
+
+        character_ids = list(self.characters)
+        now = int(time.time())
+
+        def favourites(ids, source):
+            return {"edges": [{"node": source[i]} for i in ids]}
+
+        for user_id in range(1, users + 1):
+            count = max(1, int(rng.gauss(entries_per_user, entries_per_user / 3)))
+            entries = {}
+            for media_id in rng.sample(media_ids, min(count, media)):
+                status = rng.choice(STATUSES)
+                entries[media_id] = {
+                    "mediaId": media_id,
+                    "status": status,
+                    "score": rng.randint(10, 100) if rng.random() < 0.8 else 0,
+                    "progress": rng.randint(0, 50),
+                    "notes": None,
+                    "updatedAt": now - rng.randint(0, 365 * 24 * 60 * 60),
+                    "media": self.media[media_id],
+                }
+            self.lists[user_id] = entries
+
+            self.users[user_id] = {
+                "id": user_id,
+                "name": f"user{user_id}",
+                "about": None,
+                "siteUrl": f"https://anilist.co/user/user{user_id}",
+                "avatar": {"large": f"https://img.example/avatar/{user_id}"},
+                "bannerImage": None,
+                "statistics": {
+                    "anime": {
+                        "count": len(entries) // 2,
+                        "meanScore": rng.randint(50, 80),
+                        "episodesWatched": rng.randint(0, 5000),
+                        "minutesWatched": rng.randint(0, 100000),
+                        "formats": [{"format": "TV"}],
+                        "genres": [{"genre": g} for g in rng.sample(GENRES, 3)],
+                    },
+                    "manga": {
+                        "count": len(entries) // 2,
+                        "meanScore": rng.randint(50, 80),
+                        "volumesRead": rng.randint(0, 500),
+                        "chaptersRead": rng.randint(0, 5000),
+                        "formats": [{"format": "MANGA"}],
+                        "genres": [{"genre": g} for g in rng.sample(GENRES, 3)],
+                    },
+                },
+                "options": {"profileColor": rng.choice(COLORS)},
+                "favourites": {
+                    "anime": favourites(rng.sample(media_ids[::2], 5), self.media),
+                    "manga": favourites(rng.sample(media_ids[1::2], 5), self.media),
+                    "characters": favourites(
+                        rng.sample(character_ids, 5), self.characters
+                    ),
+                    "staff": {"edges": []},
+                    "studios": {"edges": []},
+                },
+            }
+
+    def find_media(self, args):
+        """Gets the media matching Media() arguments."""
+        if args.get("id") is not None:
+            candidates = [self.media[args["id"]]] if args["id"] in self.media else []
+        elif args.get("id_in") is not None:
+            candidates = [self.media[i] for i in args["id_in"] if i in self.media]
+        else:
+            candidates = self.media.values()
+        return [
+            media
+            for media in self._search(candidates, args.get("search"), titles)
+            if match_media(media, args)
+        ]
+
+    def find_characters(self, args):
+        """Gets the characters matching Character() arguments."""
+        if args.get("id") is not None:
+            character = self.characters.get(args["id"])
+            return [character] if character else []
+        return self._search(
+            self.characters.values(), args.get("search"), lambda c: [c["name"]["full"]]
+        )
+
+    def find_users(self, args):
+        """Gets the users matching User() arguments."""
+        if args.get("id") is not None:
+            user = self.users.get(args["id"])
+            return [user] if user else []
+        if args.get("name") is not None:
+            args = dict(args, search=args["name"])
+        return self._search(
+            self.users.values(), args.get("search"), lambda u: [u["name"]]
+        )
+
+    def find_entries(self, args):
+        """Gets the list entries matching MediaList() arguments."""
+        entries = self.lists.get(args.get("userId"), {})
+        if args.get("mediaId") is not None:
+            entry = entries.get(args["mediaId"])
+            return [entry] if entry else []
+        entries = list(entries.values())
+        if args.get("type") is not None:
+            entries = [i for i in entries if i["media"]["type"] == args["type"]]
+        sort = args.get("sort")
+        if sort == "SCORE_DESC":
+            entries.sort(key=lambda i: i["score"], reverse=True)
+        elif sort == "UPDATED_TIME_DESC":
+            entries.sort(key=lambda i: i["updatedAt"], reverse=True)
+        return entries
+
+    def _search(self, items, search, names):
+        if search is None:
+            return list(items)
+        search = str(search).lower()
+        exact = [i for i in items if search in (n.lower() for n in names(i))]
+        return exact or [i for i in items if any(search in n.lower() for n in names(i))]
+
+
+def titles(media):
+    return [i for i in (media["title"]["english"], media["title"]["romaji"]) if i]
+
+
+def match_media(media, args):
+    if args.get("id") is not None and media["id"] != args["id"]:
+        return False
+    if args.get("id_in") is not None and media["id"] not in args["id_in"]:
+        return False
+    if args.get("id_greater") is not None and media["id"] <= args["id_greater"]:
+        return False
+    if args.get("type") is not None and media["type"] != args["type"]:
+        return False
+    if args.get("season") is not None and media["season"] != args["season"]:
+        return False
+    # The bot sends the year as typed.
+    if args.get("seasonYear") is not None and str(media["seasonYear"]) != str(
+        args["seasonYear"]
+    ):
+        return False
+    return True
+
+
+def tokenize(document):
+    """Splits a GraphQL document into (kind, value) tokens."""
+    tokens = []
+    for match in TOKEN.finditer(document):
+        kind = match.lastgroup
+        if kind is not None:
+            tokens.append((kind, match.group(kind)))
+    return tokens
+
+
+class Parser:
+    """Parses a GraphQL query into (alias, name, arguments, include, children)
+    selections. Values are kept unresolved: ("var", name) for variables.
+    """
+
+    def __init__(self, document):
+        self.tokens = tokenize(document)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][1]
+        return None
+
+    def take(self, expected=None):
+        kind, value = self.tokens[self.position]
+        if expected is not None and value != expected:
+            raise ValueError(f"Expected {expected}, got {value}")
+        self.position += 1
+        return value
+
+    def document(self):
+        if self.peek() == "query":
+            self.take()
+            if self.peek() not in ("{", "("):
+                self.take()
+            if self.peek() == "(":
+                # Variable definitions are not checked.
+                depth = 0
+                while True:
+                    value = self.take()
+                    depth += value == "("
+                    depth -= value == ")"
+                    if depth == 0:
+                        break
+        return self.selections()
+
+    def selections(self):
+        self.take("{")
+        result = []
+        while self.peek() != "}":
+            result.append(self.selection())
+        self.take("}")
+        return result
+
+    def selection(self):
+        alias = name = self.take()
+        if self.peek() == ":":
+            self.take()
+            name = self.take()
+        arguments = self.arguments() if self.peek() == "(" else {}
+
+        include = True
+        while self.peek() == "@":
+            self.take()
+            directive = self.take()
+            directive_args = self.arguments() if self.peek() == "(" else {}
+            if directive == "include":
+                include = directive_args.get("if", True)
+            elif directive == "skip":
+                include = ("not", directive_args.get("if", False))
+
+        children = self.selections() if self.peek() == "{" else None
+        return alias, name, arguments, include, children
+
+    def arguments(self):
+        self.take("(")
+        result = {}
+        while self.peek() != ")":
+            name = self.take()
+            self.take(":")
+            result[name] = self.value()
+        self.take(")")
+        return result
+
+    def value(self):
+        kind, value = self.tokens[self.position]
+        self.position += 1
+        if value == "$":
+            return ("var", self.take())
+        if value == "[":
+            items = []
+            while self.peek() != "]":
+                items.append(self.value())
+            self.take("]")
+            return items
+        if kind == "string":
+            return json.loads(value)
+        if kind == "number":
+            return float(value) if "." in value else int(value)
+        return {"true": True, "false": False, "null": None}.get(value, value)
+
+
+def resolve_value(value, variables):
+    if isinstance(value, tuple) and value[0] == "var":
+        return variables.get(value[1])
+    if isinstance(value, tuple) and value[0] == "not":
+        return not resolve_value(value[1], variables)
+    if isinstance(value, list):
+        return [resolve_value(i, variables) for i in value]
+    return value
+
+
+def project(value, children, variables):
+    """Keeps the selected fields of a value, under their aliases."""
+    if value is None or children is None:
+        return value
+    if isinstance(value, list):
+        return [project(i, children, variables) for i in value]
+
+    result = {}
+    for alias, name, _, include, grandchildren in children:
+        if resolve_value(include, variables):
+            result[alias] = project(value.get(name), grandchildren, variables)
+    return result
+
+
+class FakeAniList:
+    """Answers GraphQL requests from a World.
+
+    Keyword arguments:
+      world -- Synthetic catalogue.
+      latency -- Base response latency (seconds).
+      jitter -- Random extra latency, up to this much (seconds).
+      limit -- Requests allowed per period, 0 for no rate limiting.
+      period -- Rate limit period (seconds).
+    """
+
+    def __init__(self, world, latency=0.05, jitter=0.02, limit=90, period=60):
+        self.world = world
+        self.latency = latency
+        self.jitter = jitter
+        self.limit = limit
+        self.period = period
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+        self.documents = {}
+        self.requests = 0
+        self.limited = 0
+
+    def _take_token(self):
+        now = time.monotonic()
+        rate = self.limit / self.period
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False, (1 - self.tokens) / rate
+        self.tokens -= 1
+        return True, 0
+
+    def execute(self, document, variables):
+        """Runs a query and returns (status, response body)."""
+        selections = self.documents.get(document)
+        if selections is None:
+            selections = self.documents[document] = Parser(document).document()
+
+        data = {}
+        missing = False
+        for alias, name, arguments, include, children in selections:
+            if not resolve_value(include, variables):
+                continue
+            args = {k: resolve_value(v, variables) for k, v in arguments.items()}
+            value = self.resolve(name, args, children, variables)
+            data[alias] = project(
+                value, None if name == "Page" else children, variables
+            )
+            missing = missing or value is None
+
+        if missing:
+            return 404, {
+                "data": data,
+                "errors": [{"message": "Not Found.", "status": 404}],
+            }
+        return 200, {"data": data}
+
+    def resolve(self, name, args, children, variables):
+        world = self.world
+        if name == "Media":
+            found = world.find_media(args)
+        elif name == "Character":
+            found = world.find_characters(args)
+        elif name == "User":
+            found = world.find_users(args)
+        elif name == "MediaList":
+            found = world.find_entries(args)
+        elif name == "MediaListCollection":
+            entries = world.find_entries(args)
+            lists = {}
+            for entry in entries:
+                lists.setdefault(entry["status"], []).append(entry)
+            return {"lists": [{"entries": i} for i in lists.values()]}
+        elif name == "Page":
+            return self.page(args, children, variables)
+        else:
+            raise ValueError(f"Unsupported field {name}")
+        return found[0] if found else None
+
+    def page(self, args, children, variables):
+        page = args.get("page") or 1
+        per_page = min(args.get("perPage") or 50, 50)
+
+        items = []
+        result = {}
+        for alias, name, arguments, include, grandchildren in children:
+            if name == "pageInfo":
+                continue
+            list_args = {k: resolve_value(v, variables) for k, v in arguments.items()}
+            if name == "media":
+                items = self.world.find_media(list_args)
+            elif name == "mediaList":
+                items = self.world.find_entries(list_args)
+            elif name == "characters":
+                items = self.world.find_characters(list_args)
+            elif name == "users":
+                items = self.world.find_users(list_args)
+            else:
+                raise ValueError(f"Unsupported page field {name}")
+            start = (page - 1) * per_page
+            result[alias] = project(
+                items[start : start + per_page], grandchildren, variables
+            )
+
+        last_page = max(1, -(-len(items) // per_page))
+        page_info = {
+            "total": len(items),
+            "perPage": per_page,
+            "currentPage": page,
+            "lastPage": last_page,
+            "hasNextPage": page < last_page,
+        }
+        for alias, name, _, _, grandchildren in children:
+            if name == "pageInfo":
+                result[alias] = project(page_info, grandchildren, variables)
+        return result
+
+    async def handle(self, request):
+        self.requests += 1
+        headers = {}
+        if self.limit:
+            allowed, retry_after = self._take_token()
+            headers["X-RateLimit-Limit"] = str(self.limit)
+            headers["X-RateLimit-Remaining"] = str(int(self.tokens))
+            if not allowed:
+                self.limited += 1
+                headers["Retry-After"] = str(int(retry_after) + 1)
+                headers["X-RateLimit-Reset"] = str(int(time.time() + retry_after) + 1)
+                body = {"data": None, "errors": [{"message": "Too Many Requests."}]}
+                return web.json_response(body, status=429, headers=headers)
+
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        try:
+            payload = await request.json()
+            status, body = self.execute(
+                payload["query"], payload.get("variables") or {}
+            )
+        except (ValueError, KeyError, IndexError) as e:
+            status, body = 400, {"data": None, "errors": [{"message": str(e)}]}
+        return web.json_response(body, status=status, headers=headers)
+
+    def app(self):
+        """Creates the web application."""
+        app = web.Application(client_max_size=4 * 1024 * 1024)
+        app.router.add_post("/", self.handle)
+        return app
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="seconds")
+    parser.add_argument(
+        "--rate-limit", type=int, default=90, help="requests per minute, 0 for none"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--media", type=int, default=2000)
+    parser.add_argument("--characters", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--entries", type=int, default=150, help="per user")
+    return parser.parse_args(args)
+
+
+def world_from_args(args):
+    """Builds the World described by command line arguments."""
+    return World(args.seed, args.media, args.characters, args.users, args.entries)
+
+
+async def serve(server, host, port):
+    """Serves requests until cancelled.
+
+    Keyword arguments:
+      server -- FakeAniList.
+      host -- Address to listen on.
+      port -- Port to listen on.
+    """
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = FakeAniList(
+        world_from_args(args), args.latency, args.jitter, args.rate_limit
+    )
+    try:
+        asyncio.get_event_loop().run_until_complete(serve(server, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
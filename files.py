@@ -1,66 +1,328 @@
 #!/usr/bin/env python3
 
 import json
+import os
+import sqlite3
 
 USERS_FILE = "users.json"
 SETTINGS_FILE = "config.json"
+DATABASE_FILE = "ani-chan.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS links (
+    guild_id TEXT NOT NULL,
+    discord_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    anilist_id INTEGER NOT NULL,
+    display_name TEXT,
+    PRIMARY KEY (guild_id, discord_id)
+);
+CREATE TABLE IF NOT EXISTS channels (
+    guild_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    PRIMARY KEY (guild_id, channel_id)
+);
+CREATE TABLE IF NOT EXISTS list_entries (
+    anilist_id INTEGER NOT NULL,
+    media_id INTEGER NOT NULL,
+    status TEXT,
+    score INTEGER,
+    progress INTEGER,
+    updated_at INTEGER,
+    PRIMARY KEY (anilist_id, media_id)
+);
+CREATE TABLE IF NOT EXISTS list_syncs (
+    anilist_id INTEGER PRIMARY KEY,
+    synced_at REAL NOT NULL,
+    high_water INTEGER NOT NULL DEFAULT 0
+);
+"""
 
 users_glob = {}
-users = {}
 settings = {}
+connection = None
+
+
+def get_connection():
+    """Gets the database connection, creating the database on first use."""
+    global connection
+
+    if connection is None:
+        connection = sqlite3.connect(DATABASE_FILE)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        migrate_schema(connection)
+        migrate_json(connection)
+    return connection
+
+
+def migrate_schema(db):
+    """Adds columns that are missing from databases created by older versions.
+
+    Keyword arguments:
+      db -- Database connection.
+    """
+    columns = [row[1] for row in db.execute("PRAGMA table_info(list_syncs)")]
+    if "high_water" not in columns:
+        with db:
+            db.execute(
+                "ALTER TABLE list_syncs"
+                " ADD COLUMN high_water INTEGER NOT NULL DEFAULT 0"
+            )
+
+
+def migrate_json(db):
+    """Imports users and server settings from the old JSON files, once.
+
+    Keyword arguments:
+      db -- Database connection.
+    """
+    if db.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone():
+        return
+
+    with db:
+        if os.path.exists(USERS_FILE):
+            with open(USERS_FILE, "r") as users_file:
+                content = users_file.read()
+            for guild, guild_users in (json.loads(content) if content else {}).items():
+                _insert_guild(db, guild)
+                for discord_id, user in guild_users.items():
+                    _upsert_link(db, guild, discord_id, user)
+
+        if os.path.exists(SETTINGS_FILE):
+            with open(SETTINGS_FILE, "r") as settings_file:
+                servers = json.loads(settings_file.read()).get("servers") or {}
+            for guild, server in servers.items():
+                _insert_guild(db, guild)
+                _replace_channels(db, guild, server.get("channels"))
+
+        db.execute("INSERT INTO meta (key, value) VALUES ('migrated', '1')")
 
 
 def load_users():
-    """Loads users from users file."""
+    """Loads users from the database."""
     global users_glob
 
-    with open(USERS_FILE, "r") as users_file:
-        users_glob = json.loads(users_file.read())
+    db = get_connection()
+    users_glob = {guild: {} for (guild,) in db.execute("SELECT guild_id FROM guilds")}
+    for guild, discord_id, name, anilist_id, display_name in db.execute(
+        "SELECT guild_id, discord_id, name, anilist_id, display_name FROM links"
+    ):
+        users_glob.setdefault(guild, {})[discord_id] = {
+            "name": name,
+            "id": anilist_id,
+            "displayName": display_name,
+        }
     return users_glob
 
 
-def update_users(users_dict):
-    """Updates users file based on dictionary.
+def _insert_guild(db, guild):
+    db.execute("INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)", (str(guild),))
+
+
+def _upsert_link(db, guild, discord_id, user):
+    db.execute(
+        "INSERT INTO links (guild_id, discord_id, name, anilist_id, display_name)"
+        " VALUES (?, ?, ?, ?, ?) ON CONFLICT (guild_id, discord_id) DO UPDATE SET"
+        " name = excluded.name, anilist_id = excluded.anilist_id,"
+        " display_name = excluded.display_name",
+        (str(guild), str(discord_id), user["name"], user["id"], user["displayName"]),
+    )
+
+
+def _replace_channels(db, guild, channels):
+    db.execute("DELETE FROM channels WHERE guild_id = ?", (str(guild),))
+    db.executemany(
+        "INSERT OR IGNORE INTO channels (guild_id, channel_id) VALUES (?, ?)",
+        [(str(guild), str(channel)) for channel in channels or []],
+    )
+
+
+def add_guilds(guilds):
+    """Adds many guilds to the database in one transaction.
 
     Keyword arguments:
-      users_dict -- Users dictionary.
+      guilds -- Guild IDs.
     """
-    if users_dict:  # Check if dictionary is not empty
-        with open(USERS_FILE, "w") as users_file:
-            users_file.write(json.dumps(users_dict))
+    db = get_connection()
+    with db:
+        db.executemany(
+            "INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)",
+            [(str(guild),) for guild in guilds],
+        )
+
+
+def add_link(guild, discord_id, user):
+    """Adds or updates a link between a discord user and an AniList user.
+
+    Keyword arguments:
+      guild -- Guild ID.
+      discord_id -- Discord user ID.
+      user -- Linked user dictionary.
+    """
+    db = get_connection()
+    with db:
+        _insert_guild(db, guild)
+        _upsert_link(db, guild, discord_id, user)
+
+
+def remove_link(guild, discord_id):
+    """Removes the link of a discord user.
+
+    Keyword arguments:
+      guild -- Guild ID.
+      discord_id -- Discord user ID.
+    """
+    db = get_connection()
+    with db:
+        db.execute(
+            "DELETE FROM links WHERE guild_id = ? AND discord_id = ?",
+            (str(guild), str(discord_id)),
+        )
 
 
 def load_settings():
-    """Loads settings from settings file."""
+    """Loads settings from settings file and server settings from the database."""
     global settings
 
     with open(SETTINGS_FILE, "r") as settings_file:
         settings = json.loads(settings_file.read())
+
+    db = get_connection()
+    settings["servers"] = {
+        guild: {"channels": None} for (guild,) in db.execute("SELECT guild_id FROM guilds")
+    }
+    for guild, channel in db.execute("SELECT guild_id, channel_id FROM channels"):
+        server = settings["servers"].setdefault(guild, {"channels": None})
+        if server["channels"] is None:
+            server["channels"] = []
+        server["channels"].append(channel)
     return settings
 
 
-def update_settings(settings_dict):
-    """Updates settings file based on dictionary.
+def update_channels(guild, channels):
+    """Sets the command channels of a guild.
+
+    Keyword arguments:
+      guild -- Guild ID.
+      channels -- Channel IDs, None or empty for all channels.
+    """
+    db = get_connection()
+    with db:
+        _insert_guild(db, guild)
+        _replace_channels(db, guild, channels)
+
+
+def load_list_entries():
+    """Loads the synced list entries of linked users.
+
+    Returns a (entries, syncs) tuple: a list of (anilist_id, entry) tuples and
+    a dictionary of AniList ID to (full sync time, updatedAt high-water mark).
+    """
+    db = get_connection()
+    entries = [
+        (
+            anilist_id,
+            {
+                "mediaId": media_id,
+                "status": status,
+                "score": score,
+                "progress": progress,
+                "updatedAt": updated_at,
+            },
+        )
+        for anilist_id, media_id, status, score, progress, updated_at in db.execute(
+            "SELECT anilist_id, media_id, status, score, progress, updated_at"
+            " FROM list_entries"
+        )
+    ]
+    syncs = {
+        anilist_id: (synced_at, high_water)
+        for anilist_id, synced_at, high_water in db.execute(
+            "SELECT anilist_id, synced_at, high_water FROM list_syncs"
+        )
+    }
+    return entries, syncs
+
+
+def _upsert_list_entries(db, anilist_id, entries):
+    db.executemany(
+        "INSERT OR REPLACE INTO list_entries"
+        " (anilist_id, media_id, status, score, progress, updated_at)"
+        " VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (
+                anilist_id,
+                entry["mediaId"],
+                entry["status"],
+                entry["score"],
+                entry["progress"],
+                entry["updatedAt"],
+            )
+            for entry in entries
+        ],
+    )
+
+
+def replace_list_entries(anilist_id, entries, synced_at, high_water):
+    """Replaces all the synced list entries of a user.
 
     Keyword arguments:
-      settings_dict -- Settings dictionary.
+      anilist_id -- AniList user ID.
+      entries -- List entry dictionaries.
+      synced_at -- Full sync time (unix time).
+      high_water -- Latest updatedAt of the user's entries.
     """
-    if settings_dict:  # Check if dictionary is not empty
-        with open(SETTINGS_FILE, "w") as settings_file:
-            settings_file.write(json.dumps(settings_dict))
+    db = get_connection()
+    with db:
+        db.execute("DELETE FROM list_entries WHERE anilist_id = ?", (anilist_id,))
+        _upsert_list_entries(db, anilist_id, entries)
+        db.execute(
+            "INSERT OR REPLACE INTO list_syncs (anilist_id, synced_at, high_water)"
+            " VALUES (?, ?, ?)",
+            (anilist_id, synced_at, high_water),
+        )
 
 
-def validate_users(users_dict):
-    """Validates the users dictionary.
+def update_list_entries(anilist_id, entries, high_water):
+    """Adds or updates some of the synced list entries of a user.
 
     Keyword arguments:
-      users_dict -- Users dictionary.
+      anilist_id -- AniList user ID.
+      entries -- Changed list entry dictionaries.
+      high_water -- Latest updatedAt of the user's entries.
     """
-    if not users_dict:
-        return False
+    db = get_connection()
+    with db:
+        _upsert_list_entries(db, anilist_id, entries)
+        db.execute(
+            "UPDATE list_syncs SET high_water = ? WHERE anilist_id = ?",
+            (high_water, anilist_id),
+        )
+
 
-    for server in users_dict.values():
-        if server:  # if not not server
-            return True
+def remove_list_entries(anilist_id):
+    """Removes the synced list entries of a user who is not linked anymore.
 
-    return False
+    Entries of users still linked in any guild are kept, they may be synced by
+    another worker process.
+
+    Keyword arguments:
+      anilist_id -- AniList user ID.
+    """
+    db = get_connection()
+    with db:
+        if db.execute(
+            "SELECT 1 FROM links WHERE anilist_id = ?", (anilist_id,)
+        ).fetchone():
+            return
+        db.execute("DELETE FROM list_entries WHERE anilist_id = ?", (anilist_id,))
+        db.execute("DELETE FROM list_syncs WHERE anilist_id = ?", (anilist_id,))
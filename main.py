@@ -7,16 +7,31 @@ AniList discord bot.
 ###########
 
 import json
+import os
+import zlib
 import traceback
 import sys
 import asyncio
-import time
-import requests
-from discord.ext import commands
+import aiohttp
+from discord.ext import commands, tasks
 import discord
 import markdownify
 from files import *
 from queries import *
+import anilist
+import cache
+import resolver
+import pages
+import diskcache
+import embeds
+import metrics
+import profiling
+import ratelimit
+import scoreindex
+import titleindex
+import tier
+import affinity
+import recommend
 
 #############
 # VARIABLES #
@@ -29,14 +44,64 @@ BOT_VERSION = "1.4.4"
 
 
 users_glob = {}
-users = {}
 settings = {}
 
+# Persistently cached entities currently being refreshed.
+refreshing = set()
+
 # How many episodes / chapters are needed for dropped scores
 # to enter server score. (0 for no minimum)
 MIN_DROP_ANIME = 5
 MIN_DROP_MANGA = 25
 
+# How many users are queried in a single batched server scores request.
+# Keeps every request under AniList's query complexity limit.
+SCORES_CHUNK_SIZE = 50
+
+# How often newly seen guilds are written to the database (seconds).
+GUILD_FLUSH_INTERVAL = 30
+
+# How many users / pairs the affinity command shows.
+AFFINITY_COUNT = 15
+
+# How many titles the recommend command shows.
+RECOMMEND_COUNT = 10
+
+# Entity types kept in the persistent cache.
+PERSISTENT_KINDS = ("media", "character")
+
+# How often linked users' lists are synced into the score index (minutes).
+LIST_SYNC_INTERVAL = 30
+
+# How often the persistent cache is compacted (hours).
+COMPACT_INTERVAL = 6
+
+# Top medias shown per page (AniList allows up to 50 per request).
+TOP_PER_PAGE = 20
+
+# How long viewed top medias pages are kept (seconds).
+TOP_TTL = 5 * 60
+
+# Seasonal anime shown per page.
+SEASONAL_PER_PAGE = 25
+
+# Local port of the metrics endpoint (overridden by "metrics_port" in the
+# settings, null to disable it).
+METRICS_PORT = 9108
+
+# How often the event loop lag is measured (seconds).
+LAG_INTERVAL = 5
+
+# Sharded deployment settings, set by shards.py for each worker: its shards,
+# the total shard count, its index and the address of the shared tier.
+SHARD_IDS = [int(i) for i in os.environ.get("ANICHAN_SHARD_IDS", "").split(",") if i]
+SHARD_COUNT = int(os.environ.get("ANICHAN_SHARD_COUNT", 0))
+WORKER = int(os.environ.get("ANICHAN_WORKER", 0))
+TIER_ADDRESS = os.environ.get("ANICHAN_TIER")
+
+# Parts of the score command's combined request, and their resolver namespaces.
+SCORE_PARTS = {"user": "User", "anime": "Media:ANIME", "manga": "Media:MANGA"}
+
 
 #############
 # FUNCTIONS #
@@ -66,151 +131,251 @@ def string_to_hex(color):
     return COLOR_DEFAULT
 
 
-def get_user(name):
+async def get_entity(kind, namespace, name, query_id, query_search, local=None):
+    """Gets an entity from AniList by ID or name.
+
+    Names are resolved locally when possible, so repeated lookups go straight
+    to the (cached) by-ID query, and names that were not found recently are
+    not searched again.
+
+    Keyword arguments:
+      kind -- Entity type (see cache.TTLS).
+      namespace -- Resolver namespace, also the queries' root field.
+      name -- Entity ID or name.
+      query_id -- Query finding the entity by ID.
+      query_search -- Query finding the entity by name.
+      local -- Coroutine function finding the ID of a name in a local index, or
+               None.
+    """
+    field = namespace.split(":")[0]
+
+    entity_id = resolver.lookup(namespace, name)
+    if entity_id is resolver.NOT_FOUND:
+        return None
+    if entity_id is None and resolver.is_id(name):
+        entity_id = int(name)
+    if entity_id is None and local is not None:
+        entity_id = await local(name)
+
+    if entity_id is not None:
+        # Find entity by ID.
+        entity = await get_entity_by_id(kind, namespace, entity_id, query_id)
+        if entity is not None:
+            return entity
+
+    # Find entity by name.
+    data = await anilist.post(query_search, {"search": str(name)}, kind=kind)
+    entity = data[field]
+
+    if entity is None:
+        resolver.remember_missing(namespace, name)
+        return None
+
+    resolver.remember(namespace, name, entity["id"])
+    cache.store(query_id, {"id": entity["id"]}, {field: entity}, kind)
+    if kind in PERSISTENT_KINDS:
+        diskcache.put(disk_kind(namespace, query_id), entity["id"], entity)
+    return entity
+
+
+def disk_kind(namespace, query_id):
+    """Gets the persistent cache kind of an entity.
+
+    The query is part of the kind, so entries stored by older versions of a
+    query are not used.
+
+    Keyword arguments:
+      namespace -- Resolver namespace.
+      query_id -- Query finding the entity by ID.
+    """
+    return f"{namespace}:{zlib.crc32(query_id.encode()):08x}"
+
+
+async def get_entity_by_id(kind, namespace, entity_id, query_id):
+    """Gets an entity by ID from memory, the persistent cache or AniList.
+
+    Stale persistent entries are served right away and refreshed in the
+    background.
+
+    Keyword arguments:
+      kind -- Entity type (see cache.TTLS).
+      namespace -- Resolver namespace, also the query's root field.
+      entity_id -- AniList ID.
+      query_id -- Query finding the entity by ID.
+    """
+    field = namespace.split(":")[0]
+    variables = {"id": entity_id}
+
+    if kind in PERSISTENT_KINDS:
+        data = cache.lookup(query_id, variables)
+        if data is not None:
+            return data[field]
+
+        stored = diskcache.get(disk_kind(namespace, query_id), entity_id)
+        if stored is not None:
+            entity, fetched_at = stored
+            cache.store(query_id, variables, {field: entity}, kind)
+            if diskcache.is_stale(fetched_at):
+                refresh_entity(kind, namespace, entity_id, query_id)
+            return entity
+
+    data = await anilist.post(query_id, variables, kind=kind)
+    entity = data[field]
+    if entity is not None and kind in PERSISTENT_KINDS:
+        diskcache.put(disk_kind(namespace, query_id), entity_id, entity)
+    return entity
+
+
+def refresh_entity(kind, namespace, entity_id, query_id):
+    """Refreshes a persistently cached entity in the background.
+
+    Keyword arguments:
+      kind -- Entity type (see cache.TTLS).
+      namespace -- Resolver namespace, also the query's root field.
+      entity_id -- AniList ID.
+      query_id -- Query finding the entity by ID.
+    """
+    key = (namespace, entity_id)
+    if key in refreshing:
+        return
+    refreshing.add(key)
+
+    async def refresh():
+        field = namespace.split(":")[0]
+        variables = {"id": entity_id}
+        try:
+            # Skip the memory cache, it holds the stale entry.
+            data = await anilist.send(
+                query_id, variables, priority=ratelimit.BACKGROUND
+            )
+            if data[field] is not None:
+                cache.store(query_id, variables, data, kind)
+                diskcache.put(disk_kind(namespace, query_id), entity_id, data[field])
+        except Exception as e:
+            print(f"Refreshing {namespace} {entity_id} failed: {e!r}")
+        finally:
+            refreshing.discard(key)
+
+    asyncio.ensure_future(refresh())
+
+
+async def get_user(name, query_id=QUERY_USER_ID, query_search=QUERY_USER):
     """Gets a user from AniList.
 
     Keyword arguments:
       name -- User's name.
+      query_id -- Query finding the user by ID, for the fields the caller shows.
+      query_search -- Query finding the user by name, with the same fields.
     """
-    try:
-        # Try to find user by id.
-        response = requests.post(
-            URL, json={"query": QUERY_USER_ID, "variables": {"id": int(name)}}
-        )
+    return await get_entity("user", "User", name, query_id, query_search)
 
-        if response.json()["data"]["User"]:
-            return response.json()["data"]["User"]
-    except:
-        pass
 
-    # Find user by name.
-    response = requests.post(
-        URL, json={"query": QUERY_USER, "variables": {"search": name}}
-    )
+def guild_users(guild_id):
+    """Gets the users linked in a specific guild.
 
-    if response.json()["data"]["User"]:
-        return response.json()["data"]["User"]
+    Keyword arguments:
+      guild_id -- Guild ID.
+    """
+    return users_glob.setdefault(str(guild_id), {})
+
+
+def is_own_guild(guild_id):
+    """Checks whether a guild is served by this process's shards.
 
-    return None
+    Keyword arguments:
+      guild_id -- Guild ID.
+    """
+    if not SHARD_COUNT:
+        return True
+    return (int(guild_id) >> 22) % SHARD_COUNT in SHARD_IDS
 
 
-def add_user(guild, id, name, display_name):
+async def add_user(guild, id, name, display_name):
     """Adds a user to the user list.
 
     Keyword arguments:
       id -- User's ID.
       name -- AniList user name.
     """
-    user_data = get_user(name)
+    user_data = await get_user(name)
 
     if user_data is not None:
-        users[str(id)] = {
+        user = {
             "name": user_data["name"],
             "id": user_data["id"],
             "displayName": display_name,
         }
+        guild_users(guild)[str(id)] = user
 
         # Update users
-        global users_glob
-        users_glob[str(guild)] = users
-        update_users(users_glob)
-        load_users()
+        add_link(guild, id, user)
+        if not scoreindex.index.is_synced(user["id"]):
+            scoreindex.schedule(user["id"])
 
         return True
     return False
 
 
-def get_media(name, type):
+async def get_media(name, type):
     """Gets a media from AniList.
 
     Keyword arguments:
       name -- Media name.
       type -- Media type.
     """
-    try:
-        # Find media by ID.
-        response = requests.post(
-            URL,
-            json={
-                "query": QUERY_MEDIA_ID % type.upper(),
-                "variables": {"id": int(name)},
-            },
-        )
-
-        if response.json()["data"]["Media"] is not None:
-            return response.json()["data"]["Media"]
-    except:
-        pass
-
-    # Find media by name.
-    response = requests.post(
-        URL, json={"query": QUERY_MEDIA %
-                   type.upper(), "variables": {"search": name}}
+    type = type.upper()
+    return await get_entity(
+        "media",
+        f"Media:{type}",
+        name,
+        QUERY_MEDIA_ID[type],
+        QUERY_MEDIA[type],
+        lambda name: titleindex.match(name, type),
     )
 
-    if response.json()["data"]["Media"] is not None:
-        return response.json()["data"]["Media"]
-
-    return None
-
 
-def get_character(name):
+async def get_character(name):
     """Gets a character from AniList.
 
     Keyword arguments:
       name -- Character name.
     """
-    try:
-        # Find character by ID.
-        response = requests.post(
-            URL, json={"query": QUERY_CHARACTER_ID, "variables": {"id": int(name)}}
-        )
-
-        if response.json()["data"]["Character"] is not None:
-            return response.json()["data"]["Character"]
-    except:
-        pass
-
-    # Find character by name.
-    response = requests.post(
-        URL, json={"query": QUERY_CHARACTER, "variables": {"search": name}}
+    return await get_entity(
+        "character", "Character", name, QUERY_CHARACTER_ID, QUERY_CHARACTER
     )
 
-    if response.json()["data"]["Character"] is not None:
-        return response.json()["data"]["Character"]
-
-    return None
-
 
-def search_media(name, media_type=None):
-    """Searches a media on AniList.
+async def search_media(name, media_type=None):
+    """Searches a media, in the local title index once it's complete or on
+    AniList.
 
     Keyword arguments:
       name -- Search query.
       media_type -- Media type.
     """
+    if titleindex.index.complete:
+        medias = await titleindex.search(
+            name, media_type and media_type.upper(), limit=25
+        )
+        if medias:
+            return {"media": medias}
+
     variables = {
         "search": name,
         "page": 1,
         "perPage": 25,
     }
     if media_type is not None:
-        response = requests.post(
-            URL,
-            json={
-                "query": QUERY_SEARCH_MEDIA_TYPE % media_type.upper(),
-                "variables": variables,
-            },
+        data = await anilist.post(
+            QUERY_SEARCH_MEDIA_TYPE[media_type.upper()], variables, kind="search"
         )
     else:
-        response = requests.post(
-            URL, json={"query": QUERY_SEARCH_MEDIA, "variables": variables}
-        )
+        data = await anilist.post(QUERY_SEARCH_MEDIA, variables, kind="search")
 
-    return response.json()["data"]["Page"]
+    return data["Page"]
 
 
-def search_character(name):
+async def search_character(name):
     """Searches a character on AniList.
 
     Keyword arguments:
@@ -222,14 +387,12 @@ def search_character(name):
         "perPage": 25,
     }
 
-    response = requests.post(
-        URL, json={"query": QUERY_SEARCH_CHARACTER, "variables": variables}
-    )
+    data = await anilist.post(QUERY_SEARCH_CHARACTER, variables, kind="search")
 
-    return response.json()["data"]["Page"]
+    return data["Page"]
 
 
-def search_user(name):
+async def search_user(name):
     """Searches a user on AniList.
 
     Keyword arguments:
@@ -241,86 +404,222 @@ def search_user(name):
         "perPage": 25,
     }
 
-    response = requests.post(
-        URL, json={"query": QUERY_SEARCH_USER, "variables": variables}
-    )
+    data = await anilist.post(QUERY_SEARCH_USER, variables, kind="search")
 
-    return response.json()["data"]["Page"]
+    return data["Page"]
 
 
-def get_user_score(userId, mediaId, repeat=0):
-    """Gets a user score on a specific media.
+async def fetch_seasonal_page(key, page, priority):
+    """Gets a page of seasonal anime for the seasonal page cache.
 
     Keyword arguments:
-      userId -- User ID.
-      mediaId -- Media ID.
+      key -- (season, year) tuple.
+      page -- Page number.
+      priority -- Rate limit priority class.
+    """
+    season, year = key
+    return await get_seasonal(season, year, page, SEASONAL_PER_PAGE, priority)
+
+
+def seasonal_page(page, medias):
+    """Generates the message of a seasonal anime page.
+
+    Keyword arguments:
+      page -- Page number.
+      medias -- Medias on the page.
     """
-    variables = {"userId": userId, "mediaId": mediaId}
-    response = requests.post(
-        URL, json={"query": QUERY_MEDIALIST, "variables": variables}
+    result = f"```Page {page}\nID     - Name\n"
+    for media in medias:
+        title = media["title"]["english"] or media["title"]["romaji"]
+        result += f'{media["id"]} - {title}\n'
+    result += "```"
+    return result
+
+
+async def fetch_top_page(key, page, priority):
+    """Gets a page of a user's top medias for the top page cache.
+
+    Keyword arguments:
+      key -- AniList user ID.
+      page -- Page number.
+      priority -- Rate limit priority class.
+    """
+    variables = {"userId": key, "page": page, "perPage": TOP_PER_PAGE}
+    data = await anilist.post(
+        QUERY_TOP_MEDIA, variables, kind="medialist", priority=priority
     )
+    return data["Page"]
 
-    try:
-        return response.json()["data"]["MediaList"]
-    except:
-        print(response.text)
-        print(f"Error - {userId}\n{response.text}")
-        if repeat <= 5:
-            time.sleep(1)
-            # TODO: better solution
-            return get_user_score(userId, mediaId, repeat + 1)
-        else:
-            return None
 
+def top_page(media_list):
+    """Generates the description of a top medias page.
 
-def get_seasonal(season, year, page, perPage):
+    Keyword arguments:
+      media_list -- Media list entries on the page.
+    """
+    description = ""
+    for media in media_list:
+        title = media["media"]["title"]["english"] or media["media"]["title"]["romaji"]
+        description += (
+            f'{title} *[{media["media"]["type"]}]* - ' + f'**{media["score"]}**\n'
+        )
+    return description
+
+
+async def get_score_bundle(name, media_name):
+    """Gets a user, the anime and manga matching a name, and the user's entries
+    on both.
+
+    Everything is fetched in one combined request when the names were resolved
+    before. Names that still need searching take one more request.
+
+    Keyword arguments:
+      name -- User's name.
+      media_name -- Media name.
+    """
+    names = {"user": name, "anime": media_name, "manga": media_name}
+    bundle = dict.fromkeys(("user", "anime", "manga", "animeEntry", "mangaEntry"))
+
+    ids = {}
+    probes = set()
+    for part, namespace in SCORE_PARTS.items():
+        ids[part] = resolver.lookup(namespace, names[part])
+        if ids[part] is None and resolver.is_id(names[part]):
+            ids[part] = int(names[part])
+            probes.add(part)
+
+    if ids["user"] is resolver.NOT_FOUND:
+        return bundle
+
+    pending = {part for part in SCORE_PARTS if ids[part] is not resolver.NOT_FOUND}
+    entries = pending - {"user"}
+
+    def known(part):
+        return isinstance(ids[part], int)
+
+    # At most: search names, retry missed ID probes by name, fetch entries.
+    for _ in range(3):
+        variables = {}
+        for part in SCORE_PARTS:
+            variables[part] = part in pending
+            variables[part + "Id"] = ids[part] if known(part) else None
+            variables[part + "Search"] = (
+                str(names[part]) if part in pending and not known(part) else None
+            )
+        for part in ("anime", "manga"):
+            variables[part + "Entry"] = part in entries and known("user") and known(part)
+
+        requested = [part for part in bundle if variables[part]]
+        if not requested:
+            break
+        searched = {part for part in pending if not known(part)}
+
+        data = await anilist.post(QUERY_SCORE, variables, kind="medialist")
+
+        for part in requested:
+            if part.endswith("Entry"):
+                bundle[part] = data.get(part)
+                entries.discard(part[: -len("Entry")])
+                continue
+
+            entity = data.get(part)
+            pending.discard(part)
+            if entity is not None:
+                bundle[part] = entity
+                ids[part] = entity["id"]
+                if part in searched:
+                    resolver.remember(SCORE_PARTS[part], names[part], entity["id"])
+            elif part in probes:
+                # Not an ID after all, search it by name.
+                probes.discard(part)
+                ids[part] = None
+                pending.add(part)
+            else:
+                if part in searched:
+                    resolver.remember_missing(SCORE_PARTS[part], names[part])
+                ids[part] = resolver.NOT_FOUND
+                entries.discard(part)
+                if part == "user":
+                    entries.clear()
+
+    return bundle
+
+
+async def get_seasonal(season, year, page, perPage, priority=ratelimit.INTERACTIVE):
     variables = {"year": year, "page": page, "perPage": perPage}
 
-    response = requests.post(
-        URL, json={"query": QUERY_SEASONAL % season, "variables": variables}
+    data = await anilist.post(
+        QUERY_SEASONAL[season], variables, kind="seasonal", priority=priority
     )
 
-    return response.json()["data"]["Page"]
+    return data["Page"]
 
 
-def get_users_statuses(loc_users, mediaId, media_type):
-    """Gets the statuses / scores of all the connected users on a specific media.
+async def get_scores_chunk(loc_users, user_keys, mediaId):
+    """Gets the list entries of some of the connected users on a specific media.
 
     Keyword arguments:
-    mediaId -- Media ID.
+      loc_users -- Connected users dictionary.
+      user_keys -- Keys of the users to query.
+      mediaId -- Media ID.
+    """
+    query = medialist_batch({"_" + key: loc_users[key]["id"] for key in user_keys})
+
+    try:
+        data = await anilist.post(query, {"mediaId": mediaId}, kind="medialist")
+    except (anilist.AniListError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error - {len(user_keys)} users\n{e}")
+        return dict.fromkeys(user_keys)
+
+    return {key: data.get("_" + key) for key in user_keys}
+
+
+async def get_users_scores(loc_users, mediaId):
+    """Gets the list entries of all the connected users on a specific media.
+
+    Users whose lists are synced are answered from the local score index. The
+    rest are split into alias chunks that fit AniList's query complexity limit,
+    and the chunks are requested concurrently.
+
+    Keyword arguments:
+      loc_users -- Connected users dictionary.
+      mediaId -- Media ID.
     """
-    # FIXME: Find a way to speed up queries.
     result = {}
+    keys = []
+    for key, value in loc_users.items():
+        if scoreindex.index.is_synced(value["id"]):
+            entry = scoreindex.index.get(mediaId, value["id"])
+            result[key] = dict(entry) if entry is not None else None
+        else:
+            keys.append(key)
 
-    query = """
-query ($mediaId: Int) {
-    %s
-}"""
-    media_query = """
-    %s: MediaList(userId: %s, mediaId: $mediaId) {
-        status,
-        score (format: POINT_100),
-        progress,
-    },"""
-    media_query_combined = ""
+    chunks = [
+        keys[i : i + SCORES_CHUNK_SIZE] for i in range(0, len(keys), SCORES_CHUNK_SIZE)
+    ]
+    responses = await asyncio.gather(
+        *(get_scores_chunk(loc_users, chunk, mediaId) for chunk in chunks)
+    )
 
-    for user in loc_users:
-        value = loc_users[user]
-        media_query_combined += media_query % ("_" + value["name"], str(value["id"]))
+    for response in responses:
+        result.update(response)
+    return result
 
-    query = query % media_query_combined
-    # print(query)
 
-    variables = {"mediaId": mediaId}
-    response = requests.post(URL, json={"query": query, "variables": variables})
-    # print(response.text)
+async def get_users_statuses(loc_users, mediaId, media_type):
+    """Gets the statuses / scores of all the connected users on a specific media.
+
+    Keyword arguments:
+    mediaId -- Media ID.
+    """
+    result = {}
+    user_scores = await get_users_scores(loc_users, mediaId)
 
     average_score = 0
     scores = 0
     for user in loc_users:
         value = loc_users[user]
-        score = get_user_score(value["id"], mediaId)
-        # time.sleep(0.001)
+        score = user_scores[user]
         if score is not None:
             if score["score"] == 0:
                 score["score"] = "?"
@@ -390,75 +689,139 @@ query ($mediaId: Int) {
     return result_sort
 
 
-def bot_get_media(media_type, name):
+async def bot_get_media(media_type, name):
     """Gets a media from AniList and generates an embedded message.
 
     Keyword arguments:
       media_type -- Media type.
       name -- Media name.
     """
-    media = get_media(name, media_type)
+    media = await get_media(name, media_type)
     if media is None:
-        embed = discord.Embed(title="Not Found", description="):", color=COLOR_DEFAULT)
-    else:
-        # user_scores = get_users_statuses(media["id"], media["type"])
+        description = "):"
+        # Reuses the scores of the lookup above, when it got that far.
+        suggestions = await titleindex.search(name, media_type.upper(), limit=3)
+        if suggestions:
+            description = "Did you mean:\n" + "\n".join(
+                f'• {i["title"]["english"] or i["title"]["romaji"]} *({i["id"]})*'
+                for i in suggestions
+            )
+        return discord.Embed(
+            title="Not Found", description=description, color=COLOR_DEFAULT
+        )
 
-        if media["season"] is not None:
-            media["season"] = f'{media["season"].capitalize()} {media["seasonYear"]}'
+    return embeds.render(
+        f"Media:{media_type.upper()}",
+        media,
+        lambda media: media_embed(media_type, media),
+    )
 
-        # Replace 'None' with '?'
-        for i in media:
-            if media[i] is None:
-                media[i] = "?"
 
-        if media["title"]["english"] is None:
-            media["title"]["english"] = media["title"]["romaji"]
+def media_embed(media_type, media):
+    """Generates the embedded message of a media.
 
-        if not media["genres"]:
-            media["genres"] = ["?"]
+    Keyword arguments:
+      media_type -- Media type.
+      media -- Media dictionary (modified).
+    """
+    # user_scores = get_users_statuses(media["id"], media["type"])
 
-        # Shorten description
-        if len(media["description"]) >= 1024:
-            media["description"] = media["description"][:1020] + "..."
-        media["description"] = markdownify.markdownify(media["description"])
-        media["description"] = media["description"].split(" ", 65)[0:65]
-        description = " ".join(media["description"]) + "..."
+    if media["season"] is not None:
+        media["season"] = f'{media["season"].capitalize()} {media["seasonYear"]}'
 
-        embed = discord.Embed(
-            title=media["title"]["english"],
-            url=media["siteUrl"],
-            description=f'{media["title"]["native"]} - '
-            + f'{media["title"]["romaji"]}\n\n',
-            color=COLOR_DEFAULT,
-        )
-        embed.set_thumbnail(url=media["coverImage"]["extraLarge"])
-        if media["bannerImage"] != "?":
-            embed.set_image(url=media["bannerImage"])
-        embed.add_field(name="Mean Score", value=media["meanScore"])
-        embed.add_field(name="Type", value=media["type"].capitalize())
+    # Replace 'None' with '?'
+    for i in media:
+        if media[i] is None:
+            media[i] = "?"
+
+    if media["title"]["english"] is None:
+        media["title"]["english"] = media["title"]["romaji"]
+
+    if not media["genres"]:
+        media["genres"] = ["?"]
+
+    # Shorten description
+    if len(media["description"]) >= 1024:
+        media["description"] = media["description"][:1020] + "..."
+    media["description"] = markdownify.markdownify(media["description"])
+    media["description"] = media["description"].split(" ", 65)[0:65]
+    description = " ".join(media["description"]) + "..."
+
+    embed = discord.Embed(
+        title=media["title"]["english"],
+        url=media["siteUrl"],
+        description=f'{media["title"]["native"]} - '
+        + f'{media["title"]["romaji"]}\n\n',
+        color=COLOR_DEFAULT,
+    )
+    embed.set_thumbnail(url=media["coverImage"]["extraLarge"])
+    if media["bannerImage"] != "?":
+        embed.set_image(url=media["bannerImage"])
+    embed.add_field(name="Mean Score", value=media["meanScore"])
+    embed.add_field(name="Type", value=media["type"].capitalize())
+    embed.add_field(name="Status", value=media["status"].capitalize().replace("_", " "))
+    embed.add_field(name="Season", value=media["season"])
+    embed.add_field(name="Popularity", value=media["popularity"])
+    embed.add_field(name="Favourited", value=f'{media["favourites"]} times')
+    if media_type.lower() == "anime":
+        embed.add_field(name="Episodes", value=media["episodes"])
         embed.add_field(
-            name="Status", value=media["status"].capitalize().replace("_", " ")
+            name="Duration", value=f'{media["duration"]} minutes per episode'
         )
-        embed.add_field(name="Season", value=media["season"])
-        embed.add_field(name="Popularity", value=media["popularity"])
-        embed.add_field(name="Favourited", value=f'{media["favourites"]} times')
-        if media_type.lower() == "anime":
-            embed.add_field(name="Episodes", value=media["episodes"])
-            embed.add_field(
-                name="Duration", value=f'{media["duration"]} minutes per episode'
-            )
+    else:
+        embed.add_field(name="Chapters", value=media["chapters"])
+        embed.add_field(name="Volumes", value=media["volumes"])
+    embed.add_field(name="Format", value=media["format"])
+    embed.add_field(name="Genres", value=" - ".join(media["genres"]), inline=False)
+    embed.add_field(name="Description", value=description, inline=False)
+
+    # # embed.add_field(name="User Scores", value=" ")
+    # for status in user_scores:
+    #     embed.add_field(
+    #         name=status, value=" | ".join(user_scores[status]), inline=False
+    #     )
+    return embed
+
+
+def character_embed(character):
+    """Generates the embedded message of a character.
+
+    Keyword arguments:
+      character -- Character dictionary (modified).
+    """
+    if len(character["description"]) >= 1024:
+        character["description"] = character["description"][:1020] + "..."
+    character["description"] = character["description"].replace("~!", "||")
+    character["description"] = character["description"].replace("!~", "||")
+    character["name"]["alternative"].append(character["name"]["native"])
+
+    embed = discord.Embed(
+        title=character["name"]["full"],
+        description=character["description"],
+        url=character["siteUrl"],
+        color=COLOR_DEFAULT,
+    )
+    embed.set_thumbnail(url=character["image"]["large"])
+    relations = " "
+    for i in character["media"]["edges"]:
+        if i["node"]["title"]["english"] is not None:
+            relation = f'• [{i["node"]["title"]["english"]}]({i["node"]["siteUrl"]}) [{i["characterRole"].capitalize()}]\n'
         else:
-            embed.add_field(name="Chapters", value=media["chapters"])
-            embed.add_field(name="Volumes", value=media["volumes"])
-        embed.add_field(name="Format", value=media["format"])
-        embed.add_field(name="Genres", value=" - ".join(media["genres"]), inline=False)
-        embed.add_field(name="Description", value=description, inline=False)
-
-        # # embed.add_field(name="User Scores", value=" ")
-        # for status in user_scores:
-        #     embed.add_field(
-        #         name=status, value=" | ".join(user_scores[status]), inline=False
-        #     )
+            relation = f'• [{i["node"]["title"]["native"]}]({i["node"]["siteUrl"]}) [{i["characterRole"].capitalize()}]\n'
+
+        if len(relations) + len(relation) >= 1024:
+            break
+
+        relations += relation
+
+    embed.add_field(name="Relations", value=relations, inline=False)
+    embed.add_field(
+        name="Aliases",
+        value=" - ".join(character["name"]["alternative"]),
+        inline=False,
+    )
+    embed.add_field(name="AniList ID", value=character["id"])
+    embed.add_field(name="Favourites", value=character["favourites"])
     return embed
 
 
@@ -469,15 +832,69 @@ def bot_get_media(media_type, name):
 
 # Settings
 settings = load_settings()
+users_glob = load_users()
+scoreindex.load()
+titleindex.load()
 prefix = settings["prefix"]
 print(settings)
 
-intents = discord.Intents.all()
+profiling.commands.update(settings.get("profile_commands", []))
+profiling.sample_rate = settings.get("profile_sample_rate", 0)
+profiling.slow_threshold = settings.get(
+    "slow_command_threshold", profiling.SLOW_THRESHOLD
+)
 
-bot = commands.Bot(
-    command_prefix=prefix, help_command=None, case_insensitive=True, intents=intents
+recommender = recommend.Recommender(scoreindex.index)
+top_pages = pages.PageCache(fetch_top_page, "mediaList", TOP_TTL)
+seasonal_pages = pages.PageCache(
+    fetch_seasonal_page, "media", cache.TTLS["seasonal"]
 )
 
+# Message gating state: guilds already stored, guilds waiting to be stored,
+# and the command channels of guilds that restrict them.
+known_guilds = set(settings["servers"]) | set(users_glob)
+pending_guilds = set()
+channel_sets = {
+    guild: frozenset(server["channels"])
+    for guild, server in settings["servers"].items()
+    if server["channels"]
+}
+
+if settings.get("lean_intents"):
+    # Only what the commands need: no presences or typing, no member list
+    # downloads and no member cache. Linked users are shown by the names they
+    # linked with, and the members intent is kept for removal events.
+    intents = discord.Intents.default()
+    intents.members = True
+    intents.presences = False
+    intents.typing = False
+    member_options = {
+        "member_cache_flags": discord.MemberCacheFlags.none(),
+        "chunk_guilds_at_startup": False,
+    }
+else:
+    intents = discord.Intents.all()
+    member_options = {}
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix=prefix,
+        help_command=None,
+        case_insensitive=True,
+        intents=intents,
+        shard_ids=SHARD_IDS,
+        shard_count=SHARD_COUNT,
+        **member_options,
+    )
+else:
+    bot = commands.Bot(
+        command_prefix=prefix,
+        help_command=None,
+        case_insensitive=True,
+        intents=intents,
+        **member_options,
+    )
+
 
 @bot.event
 async def on_ready():
@@ -486,33 +903,126 @@ async def on_ready():
     for guild in bot.guilds:
         print(guild.id, "-", guild.name)
 
-    global users_glob
-    users_glob = load_users()
-    print(users_glob)
+    print(f"{sum(len(i) for i in users_glob.values())} linked users")
+
+    if not flush_guilds.is_running():
+        flush_guilds.start()
+    # The persistent cache is shared, one worker compacts it.
+    if WORKER == 0 and not compact_cache.is_running():
+        compact_cache.start()
+    if not sync_lists.is_running():
+        sync_lists.start()
+    if not measure_loop_lag.is_running():
+        measure_loop_lag.start()
+    if (
+        settings.get("title_crawl", True)
+        and titleindex.available()
+        and not crawl_titles.is_running()
+    ):
+        crawl_titles.start()
+
+    port = settings.get("metrics_port", METRICS_PORT)
+    if port:
+        await metrics.serve(port + WORKER)
+
+
+@tasks.loop(seconds=GUILD_FLUSH_INTERVAL)
+async def flush_guilds():
+    """Writes newly seen guilds to the database in one batch."""
+    if pending_guilds:
+        guilds = list(pending_guilds)
+        pending_guilds.clear()
+        add_guilds(guilds)
+
+
+@tasks.loop(minutes=LIST_SYNC_INTERVAL)
+async def sync_lists():
+    """Syncs the lists of the users linked in this process's guilds into the
+    score index."""
+    await scoreindex.sync(
+        user["id"]
+        for guild, users in users_glob.items()
+        if is_own_guild(guild)
+        for user in users.values()
+    )
+    await bot.loop.run_in_executor(None, recommender.update)
+
+
+@tasks.loop(seconds=titleindex.CRAWL_INTERVAL)
+async def crawl_titles():
+    """Crawls the catalogue into the title index. The index is shared in
+    cache.db, other workers only load the first one's crawl progress."""
+    if WORKER == 0:
+        await titleindex.crawl()
+    else:
+        titleindex.load()
+
+
+@tasks.loop(seconds=LAG_INTERVAL)
+async def measure_loop_lag():
+    """Measures the event loop lag."""
+    await metrics.measure_lag()
+
+
+@bot.before_invoke
+async def start_command(ctx):
+    ctx.trace = profiling.start(ctx.command.qualified_name)
+
+    # Time spent sending to Discord is a phase of its own.
+    send = ctx.send
+
+    async def traced_send(*args, **kwargs):
+        with profiling.span("discord"):
+            return await send(*args, **kwargs)
+
+    ctx.send = traced_send
+
+
+@bot.after_invoke
+async def finish_command(ctx):
+    elapsed = profiling.finish(ctx.trace)
+    metrics.command_seconds.observe(elapsed, command=ctx.command.qualified_name)
+
+
+def collect_metrics():
+    """Updates the cache and rate limit gauges before a scrape."""
+    for name, instance in (
+        ("responses", cache.responses),
+        ("names", resolver.names),
+        ("embeds", embeds.rendered),
+    ):
+        stats = instance.stats()
+        metrics.cache_hit_ratio.set(stats["hit_ratio"], cache=name)
+        metrics.cache_entries.set(stats["entries"], cache=name)
+    metrics.ratelimit_remaining.set(ratelimit.limiter.remaining())
+    for priority in ratelimit.PRIORITIES:
+        # Shown even before a class sends its first request.
+        metrics.ratelimit_queue.inc(0, priority=priority)
+
+
+metrics.collectors.append(collect_metrics)
+
+
+@tasks.loop(hours=COMPACT_INTERVAL)
+async def compact_cache():
+    """Compacts the persistent cache."""
+    await bot.loop.run_in_executor(None, diskcache.compact)
 
 
 @bot.event
 async def on_message(message):
-    global users, users_glob
-
-    if not validate_users(users_glob):
-        print("sadasd")
-        users_glob = load_users()  # Hope this works. TODO: Something better
-
-    if str(message.channel.guild.id) not in users_glob:
-        users_glob[str(message.channel.guild.id)] = {}
-        update_users(users_glob)
-    if str(message.channel.guild.id) not in settings["servers"]:
-        if settings["servers"]:
-            settings["servers"][str(message.guild.id)] = {"channels": None}
-        else:
-            settings["servers"] = {str(message.guild.id): {"channels": None}}
-        update_settings(settings)
+    # Drop everything that can't be a command before touching any state.
+    if message.guild is None or not message.content.startswith(prefix):
+        return
 
-    users = users_glob[str(message.channel.guild.id)]
-    channels = settings["servers"][str(message.guild.id)]["channels"]
+    guild = str(message.guild.id)
+    if guild not in known_guilds:
+        known_guilds.add(guild)
+        pending_guilds.add(guild)
+        settings["servers"][guild] = {"channels": None}
 
-    if channels is None or channels == [] or str(message.channel.id) in channels:
+    channels = channel_sets.get(guild)
+    if channels is None or str(message.channel.id) in channels:
         await bot.process_commands(message)
 
 
@@ -621,12 +1131,66 @@ async def set_channels(ctx, *channels):
             continue
         channels_id.append(channel)
 
-    settings["servers"][str(ctx.guild.id)]["channels"] = channels_id
-    update_settings(settings)
+    settings["servers"][str(ctx.guild.id)] = {"channels": channels_id}
+    if channels_id:
+        channel_sets[str(ctx.guild.id)] = frozenset(channels_id)
+    else:
+        channel_sets.pop(str(ctx.guild.id), None)
+    update_channels(ctx.guild.id, channels_id)
 
     await ctx.send("Channels set successfully!")
 
 
+@bot.command(
+    name="cache-stats",
+    description="_[ADMIN]_ Shows AniList response cache statistics",
+    help=prefix + "cache-stats",
+)
+async def cache_stats(ctx):
+    if not ctx.message.author.guild_permissions.administrator:
+        return
+
+    stats = cache.responses.stats()
+    stats["coalesced"] = anilist.coalesced
+    stats["render_hit_ratio"] = embeds.rendered.stats()["hit_ratio"]
+    stats["title_index"] = titleindex.index.stats()
+    result = "\n".join(f"{name}: {value}" for name, value in stats.items())
+    await ctx.send(f"```{result}```")
+
+
+@bot.command(
+    name="profile",
+    description="_[OWNER]_ Toggles profiling of a command",
+    help=prefix + "profile <command>",
+)
+async def profile(ctx, command=None):
+    """Toggles cProfile captures of every invocation of a command.
+
+    Keyword arguments:
+      ctx -- Context.
+      command -- Command name, or nothing to list the profiled commands.
+    """
+    if not await bot.is_owner(ctx.message.author):
+        return
+
+    if command is not None:
+        target = bot.get_command(command)
+        if target is None:
+            await ctx.send(f"Unknown command `{command}`")
+            return
+        name = target.qualified_name
+        if name in profiling.commands:
+            profiling.commands.discard(name)
+        else:
+            profiling.commands.add(name)
+
+    names = ", ".join(sorted(profiling.commands)) or "none"
+    await ctx.send(
+        f"Profiled commands: {names} (sample rate {profiling.sample_rate:g}), "
+        + f"captures in `{profiling.DIRECTORY}`"
+    )
+
+
 @bot.command(
     name="anime",
     description="Search for a specific anime using its name.",
@@ -647,7 +1211,7 @@ async def anime(ctx, *name):
             color=COLOR_ERROR,
         )
     else:
-        embed = bot_get_media("anime", " ".join(name))
+        embed = await bot_get_media("anime", " ".join(name))
     await ctx.send(embed=embed)
 
 
@@ -671,7 +1235,7 @@ async def manga(ctx, *name):
             color=COLOR_ERROR,
         )
     else:
-        embed = bot_get_media("manga", " ".join(name))
+        embed = await bot_get_media("manga", " ".join(name))
     await ctx.send(embed=embed)
 
 
@@ -688,6 +1252,7 @@ async def user(ctx, name=None):
       name -- User's name.
     """
 
+    users = guild_users(ctx.guild.id)
     try:
         name = users[name.strip("<@!>")]["name"]
     except:
@@ -696,7 +1261,7 @@ async def user(ctx, name=None):
     if name is None:
         name = users[str(ctx.message.author.id)]["name"]
 
-    user_data = get_user(name)
+    user_data = await get_user(name, QUERY_USER_STATS_ID, QUERY_USER_STATS)
 
     if user_data is not None:
 
@@ -708,10 +1273,6 @@ async def user(ctx, name=None):
         embed.set_thumbnail(url=user_data["avatar"]["large"])
         if user_data["bannerImage"] is not None:
             embed.set_image(url=user_data["bannerImage"])
-        if user_data["about"] is not None:
-            if len(user_data["about"]) >= 1024:
-                user_data["about"] = user_data["about"][:1020] + "..."
-            # embed.add_field(name="About", value=user_data["about"])
 
         stats_anime = user_data["statistics"]["anime"]
         if stats_anime["formats"] != []:
@@ -791,13 +1352,14 @@ async def link(ctx, name=None):
         await ctx.send(embed=embed)
         return
 
-    found_user = get_user(name)
+    users = guild_users(ctx.guild.id)
+    found_user = await get_user(name)
     for _user in users:
-        if users[_user]["name"] == found_user["name"]:
+        if found_user is not None and users[_user]["name"] == found_user["name"]:
             await ctx.send("User taken.")
             return
 
-    if add_user(
+    if await add_user(
         ctx.message.guild.id, ctx.message.author.id, name, ctx.message.author.name
     ):
         await user(ctx, name)
@@ -818,13 +1380,10 @@ async def unlink(ctx):
       ctx -- Context.
     """
 
-    global users_glob
-    del users[str(ctx.message.author.id)]
-    users_glob[(ctx.message.channel.guild.id)] = users
+    del guild_users(ctx.guild.id)[str(ctx.message.author.id)]
 
     # Update users
-    update_users(users_glob)
-    load_users()
+    remove_link(ctx.guild.id, ctx.message.author.id)
 
     embed = discord.Embed(
         title="User unlinked successfully", description="Hurrah!", color=COLOR_DEFAULT
@@ -842,31 +1401,28 @@ async def show_users(ctx):
       ctx -- Context.
     """
 
-    result = []
-    for i in users:
-        result.append(
-            f'**Discord:** {users[i]["displayName"]} - **AniList:** [{users[i]["name"]}](https://AniList.co/user/{users[i]["id"]})'
-        )
-
-    # Split users
-    s = []
-    for i in range(0, int(len(result)) + 1, 20):
-        c = result[i : i + 20]
-        if c != []:
-            s.append(c)
-    result = []
-
-    for i in s:
-        result.append("\n".join(i))
+    users = guild_users(ctx.guild.id)
+    keys = list(users)
+
+    def page_text(page):
+        # Cached members show their current name, the others the stored one.
+        result = []
+        for i in keys[(page - 1) * 20 : page * 20]:
+            member = ctx.guild.get_member(int(i))
+            name = member.name if member is not None else users[i]["displayName"]
+            result.append(
+                f'**Discord:** {name} - **AniList:** [{users[i]["name"]}](https://AniList.co/user/{users[i]["id"]})'
+            )
+        return "\n".join(result)
 
     embed = discord.Embed(
         title=f"Total linked users: {len(users)}",
-        description=f"{result[0]}",
+        description=page_text(1),
         color=COLOR_DEFAULT,
     )
     message = await ctx.send(embed=embed)
 
-    pages = len(result)
+    pages = -(-len(keys) // 20)
     cur_page = 1
 
     await message.add_reaction("◀️")
@@ -886,7 +1442,7 @@ async def show_users(ctx):
                 cur_page += 1
                 embed = discord.Embed(
                     title=f"Total linked users: {len(users)}",
-                    description=f"{result[cur_page - 1]}",
+                    description=page_text(cur_page),
                     color=COLOR_DEFAULT,
                 )
                 await message.edit(embed=embed)
@@ -897,7 +1453,7 @@ async def show_users(ctx):
                 cur_page -= 1
                 embed = discord.Embed(
                     title=f"Total linked users: {len(users)}",
-                    description=f"{result[cur_page - 1]}",
+                    description=page_text(cur_page),
                     color=COLOR_DEFAULT,
                 )
                 await message.edit(embed=embed)
@@ -917,53 +1473,121 @@ async def show_users(ctx):
     description="Shows the top medias of a user.",
     help=prefix + "top [top_count] <name|mention>",
 )
-async def top(ctx, top_count=10, name=None):
+async def top(ctx, top_count="10", name=None):
     """Shows a user's top media.
 
     Keyword arguments:
       ctx -- Context.
+      top_count -- How many medias to show.
       name -- User's name.
     """
 
+    if not str(top_count).isdigit():
+        top_count, name = "10", top_count
+    top_count = max(int(top_count), 1)
+
+    users = guild_users(ctx.guild.id)
+    user_id = None
     try:
-        name = users[name.strip("<@!>")]["name"]
+        name, user_id = users[name.strip("<@!>")]["name"], users[name.strip("<@!>")]["id"]
     except:
         pass
 
     if name is None:
         try:
             name = users[str(ctx.message.author.id)]["name"]
+            user_id = users[str(ctx.message.author.id)]["id"]
         except:
             name = " "
 
-    user_data = get_user(name)
-    if user_data is not None:
-        variables = {"userId": user_data["id"], "page": 1, "perPage": top_count}
-
-        response = requests.post(
-            URL, json={"query": QUERY_TOP_MEDIA, "variables": variables}
-        )
-        media_list = response.json()["data"]["Page"]["mediaList"]
-
-        description = ""
-        for media in media_list:
-            if media["media"]["title"]["english"] is None:
-                media["media"]["title"]["english"] = media["media"]["title"]["romaji"]
-            description += (
-                f'{media["media"]["title"]["english"]} *[{media["media"]["type"]}]* - '
-                + f'**{media["score"]}**\n'
-            )
+    if user_id is None:
+        # Unknown users are resolved first, linked users take a single request.
+        user_id = resolver.lookup("User", name)
+        if not isinstance(user_id, int):
+            user_data = await get_user(name)
+            user_id = user_data["id"] if user_data is not None else None
+
+    # Repeat views are answered from the top page cache and the cached user.
+    user_data = None
+    media_list = None
+    if user_id is not None:
+        media_list = top_pages.cached(user_id, 1)
+        cached_user = cache.lookup(QUERY_USER_ID, {"id": user_id})
+        if cached_user is not None:
+            user_data = cached_user["User"]
+        if media_list is None or user_data is None:
+            variables = {"userId": user_id, "page": 1, "perPage": TOP_PER_PAGE}
+            data = await anilist.post(QUERY_TOP_MEDIA_USER, variables, kind="medialist")
+            user_data = data["User"]
+            media_list = data["Page"]["mediaList"]
+            top_pages.put(user_id, 1, data["Page"])
+            if user_data is not None:
+                cache.store(QUERY_USER_ID, {"id": user_id}, {"User": user_data}, "user")
+
+    if user_data is None:
+        embed = discord.Embed(title="Not Found", description="):", color=COLOR_DEFAULT)
+        await ctx.send(embed=embed)
+        return
 
+    # Only the page after the shown one is fetched ahead.
+    pages_count = -(-top_count // TOP_PER_PAGE)
+    last_page = top_pages.last_page(user_id)
+    if last_page:
+        pages_count = min(pages_count, last_page)
+    if pages_count > 1:
+        top_pages.prefetch(user_id, 2)
+
+    def make_embed(page, media_list):
+        # The last page may hold more than was asked for.
+        media_list = media_list[: top_count - (page - 1) * TOP_PER_PAGE]
         embed = discord.Embed(
             title=f"{name}'s top {top_count}",
-            description=description,
+            description=top_page(media_list) or "Nothing here ):",
             color=string_to_hex(user_data["options"]["profileColor"]),
         )
         embed.set_thumbnail(url=user_data["avatar"]["large"])
-    else:
-        embed = discord.Embed(title="Not Found", description="):", color=COLOR_DEFAULT)
+        embed.set_footer(text=f"Page {page}/{pages_count}")
+        return embed
 
-    await ctx.send(embed=embed)
+    message = await ctx.send(embed=make_embed(1, media_list))
+    if pages_count == 1:
+        return
+
+    cur_page = 1
+
+    await message.add_reaction("◀️")
+    await message.add_reaction("▶️")
+
+    def check(reaction, user):
+        # This makes sure nobody except the command sender can interact with the "menu"
+        return user == ctx.author and str(reaction.emoji) in ["◀️", "▶️"]
+
+    while True:
+        try:
+            reaction, user = await bot.wait_for("reaction_add", timeout=60, check=check)
+            # waiting for a reaction to be added - times out after 60 seconds
+
+            if str(reaction.emoji) == "▶️" and cur_page != pages_count:
+                # Go to next page
+                cur_page += 1
+                media_list = await top_pages.get(user_id, cur_page, prefetch=False)
+                if cur_page < pages_count:
+                    top_pages.prefetch(user_id, cur_page + 1)
+                await message.edit(embed=make_embed(cur_page, media_list))
+                await message.remove_reaction(reaction, user)
+            elif str(reaction.emoji) == "◀️" and cur_page > 1:
+                # Go to previous page
+                cur_page -= 1
+                media_list = await top_pages.get(user_id, cur_page, prefetch=False)
+                await message.edit(embed=make_embed(cur_page, media_list))
+                await message.remove_reaction(reaction, user)
+            else:
+                # removes reactions if the user tries to go forward on the last page or
+                # backwards on the first page
+                await message.remove_reaction(reaction, user)
+        except asyncio.TimeoutError:
+            # ending the loop if user doesn't react after x seconds
+            break
 
 
 @bot.command(
@@ -988,9 +1612,9 @@ async def search(ctx, search_type=None, *search_string):
 
     elif search_type.lower() in ("media", "anime", "manga"):
         if search_type.lower() == "media":
-            medias = search_media(search_string)
+            medias = await search_media(search_string)
         elif search_type.lower() in ("anime", "manga"):
-            medias = search_media(search_string, search_type)
+            medias = await search_media(search_string, search_type)
 
         for media in medias["media"]:
             result += f'{media["type"].capitalize()} {media["id"]} - '
@@ -1008,7 +1632,7 @@ async def search(ctx, search_type=None, *search_string):
             result += title
             result += "\n"
     elif search_type.lower() == "character":
-        characters = search_character(search_string)
+        characters = await search_character(search_string)
 
         for character in characters["characters"]:
             result += f'Character {character["id"]} - '
@@ -1020,7 +1644,7 @@ async def search(ctx, search_type=None, *search_string):
 
             result += "\n"
     elif search_type.lower() == "user":
-        found_users = search_user(search_string)
+        found_users = await search_user(search_string)
 
         for user in found_users["users"]:
             result += f'User {user["id"]} - {user["name"]}\n'
@@ -1049,23 +1673,20 @@ async def score(ctx, name, *media_name):
 
     media_name = " ".join(media_name)
 
+    users = guild_users(ctx.guild.id)
     try:
-        name = users[name.strip("<@!>")]["name"]
+        name = str(users[name.strip("<@!>")]["id"])
     except:
         pass
 
-    user_data = get_user(name)
-    media = get_media(media_name, "anime")
-    media_manga = get_media(media_name, "manga")
+    bundle = await get_score_bundle(name, media_name)
+    user_data = bundle["user"]
 
-    if media is None:
-        media = media_manga
+    media, score = bundle["anime"], bundle["animeEntry"]
+    if score is None and bundle["manga"] is not None:
+        media, score = bundle["manga"], bundle["mangaEntry"]
 
     if user_data is not None and media is not None:
-        score = get_user_score(user_data["id"], media["id"])
-        if score is None:
-            score = get_user_score(user_data["id"], media_manga["id"])
-            media = media_manga
         if media["title"]["english"] is None:
             media["title"]["english"] = media["title"]["romaji"]
         if score is not None:
@@ -1107,8 +1728,6 @@ async def scores(ctx, media_type=None, *name):
       *name -- Media name.
     """
 
-    await ctx.send("This might take some time...")
-
     if media_type is None or not name:
         embed = discord.Embed(
             title="Incorrect usage",
@@ -1119,9 +1738,9 @@ async def scores(ctx, media_type=None, *name):
         return
 
     if media_type.lower() == "anime":
-        media = get_media(" ".join(name), "anime")
+        media = await get_media(" ".join(name), "anime")
     elif media_type.lower() == "manga":
-        media = get_media(" ".join(name), "manga")
+        media = await get_media(" ".join(name), "manga")
     else:
         embed = discord.Embed(
             title="Incorrect usage",
@@ -1132,8 +1751,10 @@ async def scores(ctx, media_type=None, *name):
         return
 
     if media is not None:
-        loc_users = users_glob[str(ctx.message.guild.id)]
-        user_scores = get_users_statuses(loc_users, media["id"], media["type"])
+        loc_users = guild_users(ctx.guild.id)
+        if not all(scoreindex.index.is_synced(i["id"]) for i in loc_users.values()):
+            await ctx.send("This might take some time...")
+        user_scores = await get_users_statuses(loc_users, media["id"], media["type"])
 
         if media["title"]["english"] is None:
             media["title"]["english"] = media["title"]["romaji"]
@@ -1178,96 +1799,181 @@ async def show_character(ctx, *name):
       *name -- Character's name.
     """
 
-    character = get_character(" ".join(name))
+    character = await get_character(" ".join(name))
 
     if character is not None:
-        if len(character["description"]) >= 1024:
-            character["description"] = character["description"][:1020] + "..."
-        character["description"] = character["description"].replace("~!", "||")
-        character["description"] = character["description"].replace("!~", "||")
-        character["name"]["alternative"].append(character["name"]["native"])
-
+        embed = embeds.render("Character", character, character_embed)
+    else:
         embed = discord.Embed(
-            title=character["name"]["full"],
-            description=character["description"],
-            url=character["siteUrl"],
-            color=COLOR_DEFAULT,
+            title="Incorrect usage",
+            description=f"Usage: `{prefix}character [name]`",
+            color=COLOR_ERROR,
         )
-        embed.set_thumbnail(url=character["image"]["large"])
-        relations = " "
-        for i in character["media"]["edges"]:
-            if i["node"]["title"]["english"] is not None:
-                relation = f'• [{i["node"]["title"]["english"]}]({i["node"]["siteUrl"]}) [{i["characterRole"].capitalize()}]\n'
-            else:
-                relation = f'• [{i["node"]["title"]["native"]}]({i["node"]["siteUrl"]}) [{i["characterRole"].capitalize()}]\n'
 
-            if len(relations) + len(relation) >= 1024:
-                break
+    await ctx.send(embed=embed)
 
-            relations += relation
 
-        embed.add_field(name="Relations", value=relations, inline=False)
-        embed.add_field(
-            name="Aliases",
-            value=" - ".join(character["name"]["alternative"]),
-            inline=False,
+@bot.command(
+    name="affinity",
+    description="Shows score affinity between linked users.",
+    help=prefix + "affinity <all|name|mention> <name|mention>",
+)
+async def show_affinity(ctx, user1=None, user2=None):
+    """Shows score affinity (Pearson correlation of shared scores) between
+    linked users.
+
+    Keyword arguments:
+      ctx -- Context.
+      user1 -- User's name, or "all" for the server's best pairs.
+      user2 -- User to compare with.
+    """
+
+    users = guild_users(ctx.guild.id)
+    names = {}
+    for value in users.values():
+        if scoreindex.index.is_synced(value["id"]):
+            names[value["id"]] = value["displayName"]
+    user_ids = list(names)
+
+    def find(name):
+        if name.strip("<@!>") in users:
+            return users[name.strip("<@!>")]["id"]
+        for value in users.values():
+            if value["name"].lower() == name.lower():
+                return value["id"]
+        return None
+
+    if user1 is not None and user1.lower() == "all":
+        result = await bot.loop.run_in_executor(
+            None, affinity.pairs, user_ids, scoreindex.index, AFFINITY_COUNT
+        )
+        title = "Highest affinities"
+        description = "\n".join(
+            f"{names[a]} & {names[b]} - **{value * 100:.1f}%** *({shared} shared)*"
+            for a, b, value, shared in result
         )
-        embed.add_field(name="AniList ID", value=character["id"])
-        embed.add_field(name="Favourites", value=character["favourites"])
     else:
+        user_id = find(user1 if user1 is not None else str(ctx.message.author.id))
+        if user_id not in names:
+            embed = discord.Embed(
+                title="Not Found",
+                description="User is not linked, or their lists are not synced yet.",
+                color=COLOR_ERROR,
+            )
+            await ctx.send(embed=embed)
+            return
+
+        if user2 is not None:
+            other_id = find(user2)
+            if other_id not in names:
+                embed = discord.Embed(
+                    title="Not Found",
+                    description="User is not linked, or their lists are not synced yet.",
+                    color=COLOR_ERROR,
+                )
+                await ctx.send(embed=embed)
+                return
+            user_ids = [user_id, other_id]
+
+        result = await bot.loop.run_in_executor(
+            None, affinity.ranking, user_ids, scoreindex.index, user_id
+        )
+        title = f"Affinity of {names[user_id]}"
+        description = "\n".join(
+            f"{names[other]} - **{value * 100:.1f}%** *({shared} shared)*"
+            for other, value, shared in result[:AFFINITY_COUNT]
+        )
+
+    if description == "":
+        description = f"Not enough shared scores (at least {affinity.MIN_SHARED})."
+
+    embed = discord.Embed(title=title, description=description, color=COLOR_DEFAULT)
+    await ctx.send(embed=embed)
+
+
+@bot.command(
+    name="recommend",
+    description="Recommends titles based on what similar users in the server liked.",
+    help=prefix + "recommend <anime|manga> <name|mention>",
+    aliases=["rec"],
+)
+async def show_recommendations(ctx, media_type=None, name=None):
+    """Shows titles that linked users with similar taste scored highly.
+
+    Keyword arguments:
+      ctx -- Context.
+      media_type -- Media type.
+      name -- User's name.
+    """
+
+    users = guild_users(ctx.guild.id)
+
+    if media_type is not None and media_type.upper() not in ("ANIME", "MANGA"):
+        media_type, name = None, media_type
+
+    user = None
+    if name is None:
+        user = users.get(str(ctx.message.author.id))
+    elif name.strip("<@!>") in users:
+        user = users[name.strip("<@!>")]
+    else:
+        for value in users.values():
+            if value["name"].lower() == name.lower():
+                user = value
+
+    if user is None or not scoreindex.index.is_synced(user["id"]):
         embed = discord.Embed(
-            title="Incorrect usage",
-            description=f"Usage: `{prefix}character [name]`",
+            title="Not Found",
+            description="User is not linked, or their lists are not synced yet.",
             color=COLOR_ERROR,
         )
+        await ctx.send(embed=embed)
+        return
 
-    await ctx.send(embed=embed)
+    # Over-fetch so there is enough left after filtering by type.
+    candidates = await bot.loop.run_in_executor(
+        None,
+        recommender.recommend,
+        user["id"],
+        [value["id"] for value in users.values()],
+        RECOMMEND_COUNT * (3 if media_type is not None else 1),
+    )
+
+    description = ""
+    if candidates:
+        data = await anilist.post(
+            QUERY_MEDIA_TITLES,
+            {"ids": [i for i, _ in candidates], "perPage": len(candidates)},
+            kind="media",
+        )
+        medias = {media["id"]: media for media in data["Page"]["media"]}
+
+        shown = 0
+        for media_id, predicted in candidates:
+            media = medias.get(media_id)
+            if media is None or (
+                media_type is not None and media["type"] != media_type.upper()
+            ):
+                continue
+            title = media["title"]["english"] or media["title"]["romaji"]
+            description += (
+                f'• [{title}]({media["siteUrl"]}) *[{media["type"]}]* - '
+                + f"**{predicted:.0f}**\n"
+            )
+            shown += 1
+            if shown == RECOMMEND_COUNT:
+                break
 
+    if description == "":
+        description = "Not enough scores from similar users yet."
 
-# @bot.command(
-#     name="affinity",
-#     description="TBD",
-#     help=prefix + "affinity [name|mention] [name|mention]",
-# )
-# async def affinity(ctx, user1, user2):  # TODO
-
-#     try:
-#         user1 = users[user1.strip("<@!>")]["name"]
-#     except:
-#         pass
-#     try:
-#         user2 = users[user2.strip("<@!>")]["name"]
-#     except:
-#         pass
-
-#     user1_data = get_user(user1)
-#     user2_data = get_user(user2)
-
-#     if user1_data is not None and user2_data is not None:
-#         variables1 = {"userId": user1_data["id"], "page": 1, "perPage": 50}
-#         variables2 = {"userId": user2_data["id"], "page": 1, "perPage": 50}
-
-#         response = requests.post(
-#             URL, json={"query": QUERY_TOP_MEDIA, "variables": variables1}
-#         )
-#         media_list1 = response.json()["data"]["Page"]["mediaList"]
-#         response = requests.post(
-#             URL, json={"query": QUERY_TOP_MEDIA, "variables": variables2}
-#         )
-#         media_list2 = response.json()["data"]["Page"]["mediaList"]
-
-#         # print(media_list1)
-#         # print(media_list2)
-
-#         medias1 = medias2 = []
-#         for i in media_list1:
-#             medias1.append(i["media"])
-#         for i in media_list2:
-#             medias2.append(i["media"])
-
-#         for i in medias1:
-#             if i in medias2:
-#                 print(i, ":", i in medias1 and i in medias2)
+    embed = discord.Embed(
+        title=f'Recommendations for {user["name"]}',
+        description=description,
+        color=COLOR_DEFAULT,
+    )
+    embed.set_footer(text="Predicted scores are based on similar users' scores.")
+    await ctx.send(embed=embed)
 
 
 @bot.command(
@@ -1284,6 +1990,7 @@ async def favorites(ctx, name=None):  # TODO: errors
       name -- User's name.
     """
 
+    users = guild_users(ctx.guild.id)
     try:
         name = users[name.strip("<@!>")]["id"]
     except:
@@ -1295,7 +2002,7 @@ async def favorites(ctx, name=None):  # TODO: errors
         except:
             name = " "
 
-    user = get_user(name)
+    user = await get_user(name, QUERY_USER_FAVOURITES_ID, QUERY_USER_FAVOURITES)
     if user is not None:
         embed = discord.Embed(
             title=user["name"] + "'s favourites",
@@ -1384,14 +2091,8 @@ async def seasonal(ctx, season=None, year=None):
         await ctx.send(embed=embed)
         return
 
-    medias = get_seasonal(season.upper(), year, 1, 25)
-
-    result = "```Page 1\nID     - Name\n"
-    for media in medias["media"]:
-        if media["title"]["english"] is None:
-            media["title"]["english"] = media["title"]["romaji"]
-        result += f'{media["id"]} - {media["title"]["english"]}\n'
-    result += "```"
+    key = (season.upper(), year)
+    result = seasonal_page(1, await seasonal_pages.open(key))
     message = await ctx.send(result)
 
     cur_page = 1
@@ -1410,31 +2111,18 @@ async def seasonal(ctx, season=None, year=None):
 
             if str(reaction.emoji) == "▶️":  # and cur_page != pages:
                 # Go to next page
-                cur_page += 1
-                medias = get_seasonal(season.upper(), year, cur_page, 25)
-                if not medias["media"]:
-                    cur_page -= 1
+                medias = await seasonal_pages.get(key, cur_page + 1)
+                if not medias:
                     await message.remove_reaction(reaction, user)
                     continue
-                result = f"```Page {cur_page}\nID     - Name\n"
-                for media in medias["media"]:
-                    if media["title"]["english"] is None:
-                        media["title"]["english"] = media["title"]["romaji"]
-                    result += f'{media["id"]} - {media["title"]["english"]}\n'
-                result += "```"
-                await message.edit(content=result)
+                cur_page += 1
+                await message.edit(content=seasonal_page(cur_page, medias))
                 await message.remove_reaction(reaction, user)
             elif str(reaction.emoji) == "◀️" and cur_page > 1:
                 # Go to previous page
                 cur_page -= 1
-                medias = get_seasonal(season.upper(), year, cur_page, 25)
-                result = f"```Page {cur_page}\nID     - Name\n"
-                for media in medias["media"]:
-                    if media["title"]["english"] is None:
-                        media["title"]["english"] = media["title"]["romaji"]
-                    result += f'{media["id"]} - {media["title"]["english"]}\n'
-                result += "```"
-                await message.edit(content=result)
+                medias = await seasonal_pages.get(key, cur_page)
+                await message.edit(content=seasonal_page(cur_page, medias))
                 await message.remove_reaction(reaction, user)
             else:
                 # removes reactions if the user tries to go forward on the last page or
@@ -1445,25 +2133,56 @@ async def seasonal(ctx, season=None, year=None):
             break
 
 
+def forget_member(guild_id, member_id):
+    """Unlinks a member who left a guild.
+
+    Keyword arguments:
+      guild_id -- Guild ID.
+      member_id -- Member's discord ID.
+    """
+    if guild_users(guild_id).pop(str(member_id), None) is not None:
+        remove_link(guild_id, member_id)
+
+
 @bot.event
 async def on_member_remove(member):
-    # Update users
-    global users_glob
-    del users[str(member.id)]
-    users_glob[(member.guild.id)] = users
+    forget_member(member.guild.id, member.id)
 
-    update_users(users_glob)
-    load_users()
+
+async def on_socket_response(message):
+    # Without a member cache discord.py drops removals of uncached members,
+    # so they are taken from the raw gateway event.
+    if message.get("t") == "GUILD_MEMBER_REMOVE":
+        forget_member(message["d"]["guild_id"], message["d"]["user"]["id"])
+
+
+if member_options:
+    bot.add_listener(on_socket_response)
 
 
 @bot.event
 async def on_command_error(ctx, error):
+    if ctx.command is not None:
+        metrics.command_errors.inc(command=ctx.command.qualified_name)
     await ctx.message.add_reaction("❓")
     traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
 
 
 # Run bot
-with open("./.token") as file:
-    token = file.read()
+if __name__ == "__main__":
+    with open("./.token") as file:
+        token = file.read()
 
-bot.run(token)
+    loop = asyncio.get_event_loop()
+    try:
+        if TIER_ADDRESS:
+            loop.run_until_complete(tier.connect(TIER_ADDRESS))
+        loop.run_until_complete(bot.start(token))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(bot.close())
+        loop.run_until_complete(anilist.close())
+        loop.run_until_complete(metrics.stop())
+        add_guilds(pending_guilds)
+        loop.close()
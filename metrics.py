@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""
+Prometheus style metrics, served as text on a local HTTP endpoint.
+"""
+
+import asyncio
+import bisect
+import re
+import time
+from aiohttp import web
+
+# Latency histogram buckets (seconds).
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Local address of the metrics endpoint.
+HOST = "127.0.0.1"
+
+# How many query documents have their names memoized.
+MAX_QUERY_NAMES = 1000
+
+registry = []
+# Functions called before every scrape, to update gauges.
+collectors = []
+query_names = {}
+runner = None
+
+
+def format_labels(labels):
+    """Formats a label set for the text exposition format.
+
+    Keyword arguments:
+      labels -- (name, value) tuples.
+    """
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """A named metric with a value per label set."""
+
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        registry.append(self)
+
+    def render(self):
+        """Returns the metric in the text exposition format."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Increments the count of a label set.
+
+        Keyword arguments:
+          amount -- Increment.
+          **labels -- Label values.
+        """
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down."""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        """Sets the value of a label set.
+
+        Keyword arguments:
+          value -- New value.
+          **labels -- Label values.
+        """
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, amount=1, **labels):
+        """Adds to the value of a label set.
+
+        Keyword arguments:
+          amount -- Increment, negative to decrement.
+          **labels -- Label values.
+        """
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        """Records a value.
+
+        Keyword arguments:
+          value -- Observed value.
+          **labels -- Label values.
+        """
+        key = tuple(sorted(labels.items()))
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                bucket_labels = format_labels(labels + (("le", bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = format_labels(labels + (("le", "+Inf"),))
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+
+command_seconds = Histogram(
+    "anichan_command_duration_seconds", "Command latency by command."
+)
+command_errors = Counter("anichan_command_errors_total", "Failed commands by command.")
+anilist_requests = Counter(
+    "anichan_anilist_requests_total", "AniList requests by query and status."
+)
+anilist_seconds = Histogram(
+    "anichan_anilist_request_duration_seconds", "AniList request latency by query."
+)
+cache_hit_ratio = Gauge("anichan_cache_hit_ratio", "Hit ratio by cache.")
+cache_entries = Gauge("anichan_cache_entries", "Entries by cache.")
+ratelimit_remaining = Gauge("anichan_ratelimit_remaining", "AniList request budget left.")
+ratelimit_queue = Gauge(
+    "anichan_ratelimit_queue_depth",
+    "AniList requests waiting for the rate limit by priority class.",
+)
+ratelimit_wait = Histogram(
+    "anichan_ratelimit_wait_seconds",
+    "Time AniList requests waited for the rate limit by priority class.",
+)
+loop_lag = Gauge("anichan_event_loop_lag_seconds", "Event loop scheduling delay.")
+
+
+def query_name(query):
+    """Gets a short name of a query document, from its root fields.
+
+    Keyword arguments:
+      query -- GraphQL query document.
+    """
+    name = query_names.get(query)
+    if name is not None:
+        return name
+
+    # Keep only the text of the root selection set.
+    depth = 0
+    arguments = 0
+    root = []
+    for char in query:
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+        elif char == "(":
+            arguments += 1
+        elif char == ")":
+            arguments -= 1
+        elif depth == 1 and not arguments:
+            root.append(char)
+    root = re.sub(r"@\w+|\w+\s*:", " ", "".join(root))
+
+    fields = []
+    for field in re.findall(r"\w+", root):
+        if field not in fields:
+            fields.append(field)
+    name = "+".join(fields) or "unknown"
+
+    if len(query_names) >= MAX_QUERY_NAMES:
+        query_names.clear()
+    query_names[query] = name
+    return name
+
+
+async def measure_lag():
+    """Measures how long a ready callback waits for the event loop."""
+    start = time.monotonic()
+    await asyncio.sleep(0)
+    loop_lag.set(time.monotonic() - start)
+
+
+def render():
+    """Returns all metrics in the text exposition format."""
+    for collect in collectors:
+        collect()
+
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain")
+
+
+async def serve(port, host=HOST):
+    """Starts the metrics endpoint.
+
+    Keyword arguments:
+      port -- Port to listen on.
+      host -- Address to listen on.
+    """
+    global runner
+
+    if runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+
+async def stop():
+    """Stops the metrics endpoint."""
+    global runner
+
+    if runner is not None:
+        await runner.cleanup()
+    runner = None
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""
+Page cache for paginated AniList listings.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+import ratelimit
+
+MAX_LISTINGS = 200
+
+# How many requests make a listing popular enough to be fetched whole.
+POPULAR_REQUESTS = 3
+
+
+class PageCache:
+    """Caches the pages of listings, prefetches pages ahead of the reader and
+    fetches whole listings concurrently once they are requested often.
+
+    The fetch coroutine is called as fetch(key, page, priority) and must
+    return an AniList Page dictionary whose items are under items_field.
+    Pages someone waits for are fetched as interactive requests, the others
+    as prefetch requests.
+    """
+
+    def __init__(self, fetch, items_field, ttl, max_listings=MAX_LISTINGS):
+        self.fetch = fetch
+        self.items_field = items_field
+        self.ttl = ttl
+        self.max_listings = max_listings
+        self.listings = OrderedDict()
+        self.tasks = {}
+
+    def _listing(self, key):
+        listing = self.listings.get(key)
+        if listing is None or listing["expires"] <= time.monotonic():
+            listing = {
+                "expires": time.monotonic() + self.ttl,
+                "pages": {},
+                "lastPage": None,
+                "requests": 0,
+                "complete": False,
+            }
+            self.listings[key] = listing
+            while len(self.listings) > self.max_listings:
+                self.listings.popitem(last=False)
+        self.listings.move_to_end(key)
+        return listing
+
+    async def _load(self, key, page, priority=ratelimit.INTERACTIVE):
+        listing = self._listing(key)
+        if page in listing["pages"]:
+            return listing["pages"][page]
+
+        task, task_priority = self.tasks.get((key, page), (None, None))
+        if task is None or ratelimit.more_urgent(priority, task_priority):
+            # A page someone waits for doesn't wait behind its prefetch.
+            task = asyncio.ensure_future(self.fetch(key, page, priority))
+            self.tasks[(key, page)] = (task, priority)
+
+            def land(_, task=task):
+                if self.tasks.get((key, page), (None,))[0] is task:
+                    del self.tasks[(key, page)]
+
+            task.add_done_callback(land)
+
+        result = await asyncio.shield(task)
+        items = result[self.items_field]
+        listing["pages"][page] = items
+        page_info = result.get("pageInfo")
+        if page_info and page_info.get("lastPage"):
+            listing["lastPage"] = page_info["lastPage"]
+        return items
+
+    async def open(self, key):
+        """Gets the items of the first page, counting a request of the listing.
+
+        Keyword arguments:
+          key -- Listing key.
+        """
+        self._listing(key)["requests"] += 1
+        return await self.get(key, 1)
+
+    async def get(self, key, page, prefetch=True):
+        """Gets the items of a page.
+
+        Keyword arguments:
+          key -- Listing key.
+          page -- Page number (starting at 1).
+          prefetch -- Whether to load the next page(s) in the background.
+        """
+        listing = self._listing(key)
+        items = await self._load(key, page)
+
+        if prefetch:
+            if listing["requests"] >= POPULAR_REQUESTS and not listing["complete"]:
+                self.fetch_all(key)
+            else:
+                self.prefetch(key, page + 1)
+        return items
+
+    def cached(self, key, page):
+        """Gets the items of a page if it's cached, without fetching it.
+
+        Keyword arguments:
+          key -- Listing key.
+          page -- Page number.
+        """
+        listing = self.listings.get(key)
+        if listing is None or listing["expires"] <= time.monotonic():
+            return None
+        return listing["pages"].get(page)
+
+    def last_page(self, key):
+        """Gets the last page number of a listing, or None if it's not known.
+
+        Keyword arguments:
+          key -- Listing key.
+        """
+        listing = self.listings.get(key)
+        if listing is None or listing["expires"] <= time.monotonic():
+            return None
+        return listing["lastPage"]
+
+    def put(self, key, page, result):
+        """Stores a page that was fetched elsewhere.
+
+        Keyword arguments:
+          key -- Listing key.
+          page -- Page number.
+          result -- AniList Page dictionary.
+        """
+        listing = self._listing(key)
+        listing["pages"][page] = result[self.items_field]
+        page_info = result.get("pageInfo")
+        if page_info and page_info.get("lastPage"):
+            listing["lastPage"] = page_info["lastPage"]
+
+    def prefetch(self, key, page):
+        """Loads a page in the background.
+
+        Keyword arguments:
+          key -- Listing key.
+          page -- Page number.
+        """
+        listing = self._listing(key)
+        if page in listing["pages"] or (key, page) in self.tasks:
+            return
+        if listing["lastPage"] is not None and page > listing["lastPage"]:
+            return
+        asyncio.ensure_future(self._prefetch(key, page))
+
+    async def _prefetch(self, key, page):
+        try:
+            await self._load(key, page, ratelimit.PREFETCH)
+        except Exception as e:
+            print(f"Prefetching page {page} of {key} failed: {e!r}")
+
+    def fetch_all(self, key):
+        """Loads every page of a listing concurrently in the background.
+
+        Keyword arguments:
+          key -- Listing key.
+        """
+        listing = self._listing(key)
+        if listing["lastPage"] is None:
+            return
+
+        listing["complete"] = True
+        for page in range(1, listing["lastPage"] + 1):
+            self.prefetch(key, page)
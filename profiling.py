@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""
+Per-command phase timings, opt-in cProfile captures and the slow command log.
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import json
+import os
+import random
+import time
+
+# Where captured profiles are written, and how many captures are kept.
+DIRECTORY = "profiles"
+MAX_CAPTURES = 50
+
+# Commands slower than this are logged with their phases (seconds).
+SLOW_THRESHOLD = 2.0
+
+# Commands always profiled, and the fraction of other commands profiled.
+commands = set()
+sample_rate = 0.0
+slow_threshold = SLOW_THRESHOLD
+
+current = contextvars.ContextVar("trace", default=None)
+# Only one cProfile capture can run at a time.
+profiler = None
+
+
+class Trace:
+    """Timings of one command invocation, split by phase."""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.active = True
+        self.profile = None
+
+
+@contextlib.contextmanager
+def span(phase):
+    """Adds the time spent in a block to a phase of the current command.
+
+    Keyword arguments:
+      phase -- Phase name (e.g. "network").
+    """
+    trace = current.get()
+    if trace is None or not trace.active:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.phases[phase] = trace.phases.get(phase, 0) + time.perf_counter() - start
+
+
+def start(name):
+    """Starts timing a command, profiling it if it's selected.
+
+    Tasks started by the command share its trace.
+
+    Keyword arguments:
+      name -- Command name.
+    """
+    global profiler
+
+    trace = Trace(name)
+    current.set(trace)
+    if profiler is None and (name in commands or random.random() < sample_rate):
+        profiler = trace.profile = cProfile.Profile()
+        trace.profile.enable()
+    return trace
+
+
+def finish(trace):
+    """Stops timing a command, writes its capture and logs it if it was slow.
+
+    Keyword arguments:
+      trace -- Trace returned by start().
+    """
+    global profiler
+
+    elapsed = time.perf_counter() - trace.started
+    trace.active = False
+    if trace.profile is not None:
+        trace.profile.disable()
+        profiler = None
+
+    if elapsed >= slow_threshold:
+        phases = breakdown(trace, elapsed)
+        print(f"Slow command {trace.name} ({elapsed:.2f}s): {phases}")
+    if trace.profile is not None:
+        try:
+            write(trace, elapsed)
+        except OSError as e:
+            print(f"Writing the profile of {trace.name} failed: {e!r}")
+    return elapsed
+
+
+def breakdown(trace, elapsed):
+    """Formats the phases of a command, slowest first.
+
+    Phases of concurrent tasks overlap, so they can add up to more than the
+    command took.
+
+    Keyword arguments:
+      trace -- Finished trace.
+      elapsed -- Command duration (seconds).
+    """
+    phases = sorted(trace.phases.items(), key=lambda i: i[1], reverse=True)
+    other = max(0.0, elapsed - sum(trace.phases.values()))
+    phases.append(("other", other))
+    return ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in phases)
+
+
+def write(trace, elapsed):
+    """Writes the cProfile stats and phase timings of a command.
+
+    Keyword arguments:
+      trace -- Finished trace with a profile.
+      elapsed -- Command duration (seconds).
+    """
+    os.makedirs(DIRECTORY, exist_ok=True)
+    base = os.path.join(
+        DIRECTORY,
+        f"{time.strftime('%Y%m%d-%H%M%S')}-{trace.name}-{int(elapsed * 1000)}ms",
+    )
+    trace.profile.dump_stats(base + ".prof")
+    with open(base + ".json", "w") as phases_file:
+        json.dump(
+            {"command": trace.name, "elapsed": elapsed, "phases": trace.phases},
+            phases_file,
+        )
+    rotate()
+
+
+def rotate():
+    """Removes the oldest captures past MAX_CAPTURES."""
+    captures = sorted(
+        (entry for entry in os.scandir(DIRECTORY) if entry.name.endswith(".prof")),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    for entry in captures[: max(0, len(captures) - MAX_CAPTURES)]:
+        for path in (entry.path, entry.path[: -len(".prof")] + ".json"):
+            with contextlib.suppress(OSError):
+                os.remove(path)
@@ -1,446 +1,371 @@
 #!/usr/bin/env python3
 
-URL = "https://graphql.anilist.co"
-QUERY_USER = """
-query ($search: String) {
-    User (search: $search) {
-        name,
-        id,
-        about,
-        siteUrl,
-        avatar {
-            large,
-        },
-        bannerImage,
-        statistics {
-            anime {
-                count,
-                meanScore,
-                episodesWatched,
-                minutesWatched,
-                formats (limit: 3) {
-                    format,
-                },
-                genres (limit: 3) {
-                    genre,
-                },
-            },
-            manga {
-                count,
-                meanScore,
-                volumesRead,
-                chaptersRead,
-                formats (limit: 3) {
-                    format,
-                },
-                genres (limit: 3) {
-                    genre,
-                },
-            },
-
-        },
-        options {
-            profileColor,
-        },
-        favourites {
-            anime (page: 1, perPage: 5){
-                edges {
-                    node {
-                        title {
-                            english,
-                            romaji,
-                            native,
-                        },
-                        id,
-                        siteUrl,
-                    },
-                },
-            },
-            manga (page: 1, perPage: 5){
-                edges {
-                    node {
-                        title{
-                            english,
-                            romaji,
-                            native,
-                        },
-                        id,
-                        siteUrl,
-                    },
-                },
-            },
-            characters (page: 1, perPage: 5){
-                edges {
-                    node {
-                        name {
-                            full,
-                            native,
-                        },
-                        id,
-                        siteUrl,
-                    },
-                },
-            },
-            staff (page: 1, perPage: 5){
-                edges {
-                    node{
-                        name {
-                            full,
-                            native,
-                        },
-                        id,
-                        siteUrl,
-                    },
-                },
-            },
-            studios (page: 1, perPage: 5){
-                edges {
-                    node{
-                        name,
-                        id,
-                        siteUrl,
-                    },
-                },
-            },
-        },
-    },
-}
-"""
-QUERY_USER_ID = """
-query ($id: Int) {
-    User (id: $id) {
-        name,
-        id,
-        about,
-        siteUrl,
-        avatar {
-            large,
-        },
-        bannerImage,
-        statistics {
-            anime {
-                count,
-                meanScore,
-                episodesWatched,
-                minutesWatched,
-                formats (limit: 3) {
-                    format,
-                },
-                genres (limit: 3) {
-                    genre,
-                },
-            },
-            manga {
-                count,
-                meanScore,
-                volumesRead,
-                chaptersRead,
-                formats (limit: 3) {
-                    format,
-                },
-                genres (limit: 3) {
-                    genre,
-                },
-            },
-
-        },
-        options {
-            profileColor,
-        },
-        favourites {
-            anime (page: 1, perPage: 5){
-                edges {
-                    node {
-                        title {
-                            english,
-                            romaji,
-                            native,
-                        },
-                        id,
-                        siteUrl,
-                    },
-                },
-            },
-            manga (page: 1, perPage: 5){
-                edges {
-                    node {
-                        title{
-                            english,
-                            romaji,
-                            native,
-                        },
-                        id,
-                        siteUrl,
-                    },
-                },
-            },
-            characters (page: 1, perPage: 5){
-                edges {
-                    node{
-                        name {
-                            full,
-                            native,
-                        },
-                        id,
-                        siteUrl,
-                    },
-                },
-            },
-            staff (page: 1, perPage: 5){
-                edges {
-                    node{
-                        name {
-                            full,
-                            native,
-                        },
-                        id,
-                        siteUrl,
-                    },
-                },
-            },
-            studios (page: 1, perPage: 5){
-                edges {
-                    node{
-                        name,
-                        id,
-                        siteUrl,
-                    },
-                },
-            },
-        },
-    },
-}
-"""
-QUERY_MEDIA = """
-query ($search: String) {
-    Media (search: $search, type: %s, genre_not_in: ["hentai"]) {
-        title {
-            english,
-            native,
-            romaji,
-        },
-        id,
-        meanScore,
-        description,
-        coverImage {
-            extraLarge,
-        },
-        bannerImage,
-        siteUrl,
-        genres,
-        type,
-        status,
-        format,
-        season,
-        seasonYear,
-        episodes,
-        popularity,
-        duration,
-        favourites,
-        chapters,
-        volumes,
-    },
-}
-"""
-QUERY_MEDIA_ID = """
-query ($id: Int) {
-    Media (id: $id, type: %s, genre_not_in: ["hentai"]) {
-        title {
-            english,
-            native,
-            romaji,
-        },
-        id,
-        meanScore,
-        description,
-        coverImage {
-            extraLarge,
-        },
-        bannerImage,
-        siteUrl,
-        genres,
-        type,
-        status,
-        format,
-        season,
-        seasonYear,
-        episodes,
-        popularity,
-        duration,
-        favourites,
-        chapters,
-        volumes,
-    },
-}
-"""
-QUERY_CHARACTER = """
-query ($search: String) {
-    Character (search: $search) {
-        id,
-        name {
-            full,
-            native,
-            alternative,
-        },
-        image {
-            large,
-        },
-        description,
-        gender,
-        dateOfBirth {
-            year,
-            month,
-            day,
-        },
-        age,
-        siteUrl,
-        media {
-            edges {
-                relationType,
-                characterRole,
-                node {
-                    title {
-                        english,
-                        native,
-                        romaji,
-                    },
-                    siteUrl,
-                },
-            },
-        },
-        favourites,
-    },
-}
 """
-QUERY_CHARACTER_ID = """
-query ($id: Int) {
-    Character (id: $id) {
-        id,
-        name {
-            full,
-            native,
-            alternative,
-        },
-        image {
-            large,
-        },
-        description,
-        gender,
-        dateOfBirth {
-            year,
-            month,
-            day,
-        },
-        age,
-        siteUrl,
-        media {
-            edges {
-                relationType,
-                characterRole,
-                node {
-                    title {
-                        english,
-                        native,
-                        romaji,
-                    },
-                    siteUrl,
-                },
-            },
-        },
-        favourites,
-    },
-}
-"""
-QUERY_MEDIALIST = """
-query ($userId: Int, $mediaId: Int) {
-    MediaList(userId: $userId, mediaId: $mediaId) {
-        status,
-        score (format: POINT_100),
-        progress,
-        notes,
-    },
-}
+AniList GraphQL documents.
+
+Documents are composed from shared fragments, ask only for the fields their
+command shows, and are minified once at import time. Every media type and
+season variant is built up front, so requests only pick a prebuilt document.
 """
-QUERY_TOP_MEDIA = """
-query ($userId: Int, $page: Int, $perPage: Int) {
-    Page (page: $page, perPage: $perPage) {
-        mediaList (userId: $userId, sort: SCORE_DESC) {
-            media {
-                title {
-                    english,
-                    romaji,
-                    native,
-                },
-                type,
-            },
-            score (format: POINT_100),
-        },
-    },
+
+import re
+
+URL = "https://graphql.anilist.co"
+
+MEDIA_TYPES = ("ANIME", "MANGA")
+SEASONS = ("WINTER", "SPRING", "SUMMER", "FALL")
+
+# Strings, and runs of anything but whitespace, commas and strings.
+TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[^\s,"]+')
+NAME_CHARACTER = re.compile(r"[_0-9A-Za-z]")
+
+
+def minify(document):
+    """Removes the whitespace and commas a GraphQL document doesn't need.
+
+    Keyword arguments:
+      document -- GraphQL document.
+    """
+    result = ""
+    for token in TOKEN.findall(document):
+        # Only two names (or numbers) in a row need a separator.
+        if (
+            result
+            and NAME_CHARACTER.match(result[-1])
+            and NAME_CHARACTER.match(token[0])
+        ):
+            result += " "
+        result += token
+    return result
+
+
+def field(name, selection=None, arguments=None, alias=None, directive=None):
+    """Builds a field.
+
+    Keyword arguments:
+      name -- Field name.
+      selection -- Selected subfields.
+      arguments -- Field arguments (e.g. "id: $id").
+      alias -- Field alias.
+      directive -- Field directive (e.g. "@include(if: $user)").
+    """
+    result = f"{alias}: {name}" if alias is not None else name
+    if arguments:
+        result += f"({arguments})"
+    if directive is not None:
+        result += f" {directive}"
+    if selection is not None:
+        result += f" {{ {selection} }}"
+    return result
+
+
+def query(variables, *fields):
+    """Builds a minified query.
+
+    Keyword arguments:
+      variables -- Variable definitions (e.g. "$id: Int"), or None.
+      *fields -- Root fields.
+    """
+    definitions = f"({variables})" if variables else ""
+    return minify(f"query{definitions} {{ {' '.join(fields)} }}")
+
+
+def entity_queries(root, selection, arguments=None):
+    """Builds the queries finding an entity by ID and by name.
+
+    Keyword arguments:
+      root -- Root field.
+      selection -- Selected entity fields.
+      arguments -- Root field arguments besides the ID or name.
+    """
+    extra = f", {arguments}" if arguments else ""
+    return (
+        query("$id: Int", field(root, selection, f"id: $id{extra}")),
+        query("$search: String", field(root, selection, f"search: $search{extra}")),
+    )
+
+
+def page(selection, page_info=None):
+    """Builds a Page field.
+
+    Keyword arguments:
+      selection -- Page contents.
+      page_info -- Selected pageInfo fields.
+    """
+    if page_info is not None:
+        selection = f"{field('pageInfo', page_info)} {selection}"
+    return field("Page", selection, "page: $page, perPage: $perPage")
+
+
+#############
+# FRAGMENTS #
+#############
+
+NO_HENTAI = 'genre_not_in: ["hentai"]'
+SCORE = "score(format: POINT_100)"
+PAGE_VARIABLES = "$page: Int, $perPage: Int"
+
+TITLE = "title { english romaji native }"
+SHORT_TITLE = "title { english romaji }"
+NAME = "name { full native }"
+
+USER_HEADER = "id name avatar { large } options { profileColor }"
+USER_STATISTICS = """
+statistics {
+    anime {
+        count meanScore episodesWatched minutesWatched
+        formats(limit: 3) { format }
+        genres(limit: 3) { genre }
+    }
+    manga {
+        count meanScore volumesRead chaptersRead
+        formats(limit: 3) { format }
+        genres(limit: 3) { genre }
+    }
 }
 """
-QUERY_SEARCH_MEDIA = """
-query ($search: String, $page: Int, $perPage: Int) {
-    Page (page: $page, perPage: $perPage) {
-        media (search: $search, genre_not_in: ["hentai"]) {
-            id,
-            title {
-                english,
-                native,
-                romaji,
-            },
-            type,
-        },
-    },
-}
+
+
+def favourites(connection, node):
+    """Builds a connection of a user's first 5 favourites.
+
+    Keyword arguments:
+      connection -- Favourites field (e.g. "anime").
+      node -- Selected node fields.
+    """
+    return field(
+        connection, f"edges {{ node {{ id siteUrl {node} }} }}", "page: 1, perPage: 5"
+    )
+
+
+USER_FAVOURITES = field(
+    "favourites",
+    " ".join(
+        (
+            favourites("anime", SHORT_TITLE),
+            favourites("manga", SHORT_TITLE),
+            favourites("characters", NAME),
+            favourites("staff", NAME),
+            favourites("studios", "name"),
+        )
+    ),
+)
+
+MEDIA_CARD = f"""
+{TITLE} id type meanScore description coverImage {{ extraLarge }} bannerImage
+siteUrl genres status format season seasonYear popularity favourites
 """
-QUERY_SEARCH_MEDIA_TYPE = """
-query ($search: String, $page: Int, $perPage: Int) {
-    Page (page: $page, perPage: $perPage) {
-        media (search: $search, type: %s, genre_not_in: ["hentai"]) {
-            id,
-            title {
-                english,
-                native,
-                romaji,
-            },
-            type,
-        },
-    },
-}
+# Fields only shown for one of the media types.
+MEDIA_CARD_FIELDS = {"ANIME": "episodes duration", "MANGA": "chapters volumes"}
+
+CHARACTER_CARD = """
+id name { full native alternative } image { large } description siteUrl
+favourites
+media { edges { characterRole node { title { english native } siteUrl } } }
 """
-QUERY_SEARCH_CHARACTER = """
-query ($search: String, $page: Int, $perPage: Int) {
-    Page (page: $page, perPage: $perPage) {
-        characters(search: $search) {
-            id,
-            name {
-                full,
-                native,
-            },
-        },
-    },
+
+LIST_ENTRY = f"status {SCORE} progress"
+LIST_SYNC_ENTRY = f"mediaId status {SCORE} progress updatedAt"
+
+###########
+# QUERIES #
+###########
+
+# Users: just enough to link or resolve them, the statistics card and the
+# favourites card.
+QUERY_USER_ID, QUERY_USER = entity_queries("User", USER_HEADER)
+QUERY_USER_STATS_ID, QUERY_USER_STATS = entity_queries(
+    "User", f"{USER_HEADER} siteUrl bannerImage {USER_STATISTICS}"
+)
+QUERY_USER_FAVOURITES_ID, QUERY_USER_FAVOURITES = entity_queries(
+    "User", f"{USER_HEADER} {USER_FAVOURITES}"
+)
+
+# Media cards by media type.
+MEDIA_QUERIES = {
+    media_type: entity_queries(
+        "Media",
+        f"{MEDIA_CARD} {MEDIA_CARD_FIELDS[media_type]}",
+        f"type: {media_type}, {NO_HENTAI}",
+    )
+    for media_type in MEDIA_TYPES
 }
-"""
-QUERY_SEARCH_USER = """
-query ($search: String, $page: Int, $perPage: Int) {
-    Page (page: $page, perPage: $perPage) {
-        users(search: $search) {
-            id,
-            name,
-        },
-    },
+QUERY_MEDIA_ID = {key: value[0] for key, value in MEDIA_QUERIES.items()}
+QUERY_MEDIA = {key: value[1] for key, value in MEDIA_QUERIES.items()}
+
+QUERY_CHARACTER_ID, QUERY_CHARACTER = entity_queries("Character", CHARACTER_CARD)
+
+QUERY_MEDIALIST_COLLECTIONS = query(
+    "$userId: Int",
+    *(
+        field(
+            "MediaListCollection",
+            field("lists", field("entries", LIST_SYNC_ENTRY)),
+            f"userId: $userId, type: {media_type}",
+            alias=media_type.lower(),
+        )
+        for media_type in MEDIA_TYPES
+    ),
+)
+
+
+def medialist_batch(user_ids):
+    """Builds a query getting several users' entries on the media $mediaId.
+
+    Keyword arguments:
+      user_ids -- AniList user IDs, by response alias.
+    """
+    return query(
+        "$mediaId: Int",
+        *(
+            field(
+                "MediaList", LIST_ENTRY, f"userId: {user_id}, mediaId: $mediaId", alias
+            )
+            for alias, user_id in user_ids.items()
+        ),
+    )
+
+
+def medialist_delta_batch(user_pages, per_page):
+    """Builds a query getting a page of most recently updated entries for each
+    of some users, aliased "_<user ID>".
+
+    Keyword arguments:
+      user_pages -- (user ID, page) tuples.
+      per_page -- Entries per page.
+    """
+    return query(
+        None,
+        *(
+            field(
+                "Page",
+                field("pageInfo", "hasNextPage")
+                + " "
+                + field(
+                    "mediaList",
+                    LIST_SYNC_ENTRY,
+                    f"userId: {user_id}, sort: UPDATED_TIME_DESC",
+                ),
+                f"page: {page_number}, perPage: {per_page}",
+                alias=f"_{user_id}",
+            )
+            for user_id, page_number in user_pages
+        ),
+    )
+
+
+TOP_MEDIA_PAGE = page(
+    field(
+        "mediaList",
+        f"media {{ {SHORT_TITLE} type }} {SCORE}",
+        "userId: $userId, sort: SCORE_DESC",
+    ),
+    "lastPage",
+)
+QUERY_TOP_MEDIA = query(f"$userId: Int, {PAGE_VARIABLES}", TOP_MEDIA_PAGE)
+QUERY_TOP_MEDIA_USER = query(
+    f"$userId: Int, {PAGE_VARIABLES}",
+    field("User", USER_HEADER, "id: $userId"),
+    TOP_MEDIA_PAGE,
+)
+
+QUERY_SCORE = query(
+    """
+    $userId: Int, $userSearch: String,
+    $animeId: Int, $animeSearch: String,
+    $mangaId: Int, $mangaSearch: String,
+    $user: Boolean!, $anime: Boolean!, $manga: Boolean!,
+    $animeEntry: Boolean!, $mangaEntry: Boolean!
+    """,
+    field(
+        "User",
+        USER_HEADER,
+        "id: $userId, search: $userSearch",
+        "user",
+        "@include(if: $user)",
+    ),
+    *(
+        field(
+            "Media",
+            f"id type {SHORT_TITLE}",
+            f"id: ${part}Id, search: ${part}Search, type: {media_type}, {NO_HENTAI}",
+            part,
+            f"@include(if: ${part})",
+        )
+        for part, media_type in (("anime", "ANIME"), ("manga", "MANGA"))
+    ),
+    *(
+        field(
+            "MediaList",
+            f"{LIST_ENTRY} notes",
+            f"userId: $userId, mediaId: ${part}Id",
+            f"{part}Entry",
+            f"@include(if: ${part}Entry)",
+        )
+        for part in ("anime", "manga")
+    ),
+)
+
+QUERY_MEDIA_TITLES = query(
+    "$ids: [Int], $perPage: Int",
+    field(
+        "Page",
+        field("media", f"id type siteUrl {SHORT_TITLE}", "id_in: $ids"),
+        "perPage: $perPage",
+    ),
+)
+
+SEARCH_MEDIA = f"id {TITLE} type"
+QUERY_SEARCH_MEDIA = query(
+    f"$search: String, {PAGE_VARIABLES}",
+    page(field("media", SEARCH_MEDIA, f"search: $search, {NO_HENTAI}")),
+)
+QUERY_SEARCH_MEDIA_TYPE = {
+    media_type: query(
+        f"$search: String, {PAGE_VARIABLES}",
+        page(
+            field(
+                "media",
+                SEARCH_MEDIA,
+                f"search: $search, type: {media_type}, {NO_HENTAI}",
+            )
+        ),
+    )
+    for media_type in MEDIA_TYPES
 }
-"""
-QUERY_SEASONAL = """
-query ($year: Int, $page: Int, $perPage: Int) {
-    Page(page: $page, perPage: $perPage) {
-        media(season: %s, seasonYear: $year) {
-            title {
-                english
-                romaji
-            },
-            id,
-        }
-    }
+QUERY_SEARCH_CHARACTER = query(
+    f"$search: String, {PAGE_VARIABLES}",
+    page(field("characters", f"id {NAME}", "search: $search")),
+)
+QUERY_SEARCH_USER = query(
+    f"$search: String, {PAGE_VARIABLES}",
+    page(field("users", "id name", "search: $search")),
+)
+
+# Catalogue crawl for the title index, by ascending ID after a cursor.
+QUERY_CATALOGUE = query(
+    "$after: Int, $perPage: Int",
+    field(
+        "Page",
+        field("pageInfo", "hasNextPage")
+        + " "
+        + field(
+            "media",
+            f"id type {TITLE} synonyms popularity",
+            f"id_greater: $after, sort: ID, {NO_HENTAI}",
+        ),
+        "page: 1, perPage: $perPage",
+    ),
+)
+
+# Seasonal anime by season.
+QUERY_SEASONAL = {
+    season: query(
+        f"$year: Int, {PAGE_VARIABLES}",
+        page(
+            field("media", f"{SHORT_TITLE} id", f"season: {season}, seasonYear: $year"),
+            "lastPage",
+        ),
+    )
+    for season in SEASONS
 }
-"""
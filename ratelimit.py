@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Process-wide AniList rate limit scheduler.
+"""
+
+import asyncio
+import collections
+import random
+import time
+
+# AniList allows 90 requests per minute per client.
+DEFAULT_LIMIT = 90
+DEFAULT_PERIOD = 60
+
+# Request priority classes, most urgent first: commands someone is waiting
+# on, pages prefetched for a reader, and background syncs and crawls.
+INTERACTIVE = "interactive"
+PREFETCH = "prefetch"
+BACKGROUND = "background"
+PRIORITIES = (INTERACTIVE, PREFETCH, BACKGROUND)
+
+# Share of the budget each class leaves to the more urgent ones: it only
+# takes a token while more than this is left, and is postponed otherwise.
+RESERVES = {INTERACTIVE: 0, PREFETCH: 0.1, BACKGROUND: 0.3}
+
+# Backoff between retries (seconds).
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+
+class RateLimiter:
+    """Token bucket driven by AniList's rate limit response headers.
+
+    Callers queue up on acquire() by priority class, in FIFO order within a
+    class, so bursts wait for budget instead of failing with 429s. Waiting
+    requests of a less urgent class are passed by every more urgent one.
+    """
+
+    def __init__(self, limit=DEFAULT_LIMIT, period=DEFAULT_PERIOD):
+        self.limit = limit
+        self.period = period
+        self.tokens = float(limit)
+        self.blocked_until = 0.0
+        self.updated = time.monotonic()
+        self.queues = {priority: collections.deque() for priority in PRIORITIES}
+        self._dispatcher = None
+        self._wakeup = None
+
+    @property
+    def rate(self):
+        """Tokens regained per second."""
+        return self.limit / self.period
+
+    def _refill(self, now):
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def remaining(self):
+        """Returns the request budget currently left."""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.blocked_until:
+            return 0
+        return int(self.tokens)
+
+    async def acquire(self, priority=INTERACTIVE):
+        """Waits until a request may be sent and takes a token for it.
+
+        Keyword arguments:
+          priority -- Priority class (see PRIORITIES).
+        """
+        waiter = asyncio.get_event_loop().create_future()
+        self.queues[priority].append(waiter)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        elif self._wakeup is not None and not self._wakeup.done():
+            # It may be more urgent than what the dispatcher waits for.
+            self._wakeup.set_result(None)
+        await waiter
+
+    def _next(self):
+        # Most urgent priority class with a waiting request, dropping
+        # cancelled waiters.
+        for priority, queue in self.queues.items():
+            while queue and queue[0].done():
+                queue.popleft()
+            if queue:
+                return priority
+        return None
+
+    async def _dispatch(self):
+        # Hands out tokens until nobody waits, sleeping until the next token
+        # or a new request.
+        while True:
+            priority = self._next()
+            if priority is None:
+                return
+            now = time.monotonic()
+            self._refill(now)
+            wait = self.blocked_until - now
+            if wait <= 0:
+                needed = 1 + RESERVES[priority] * self.limit
+                if self.tokens >= needed:
+                    self.tokens -= 1
+                    self.queues[priority].popleft().set_result(None)
+                    continue
+                wait = (needed - self.tokens) / self.rate
+            self._wakeup = asyncio.get_event_loop().create_future()
+            await asyncio.wait([self._wakeup], timeout=wait)
+
+    def update(self, headers):
+        """Corrects the bucket using the headers of a response.
+
+        Keyword arguments:
+          headers -- Response headers.
+        """
+        now = time.monotonic()
+        self._refill(now)
+
+        try:
+            self.limit = int(headers["X-RateLimit-Limit"])
+        except (KeyError, ValueError):
+            pass
+        try:
+            self.tokens = min(self.tokens, int(headers["X-RateLimit-Remaining"]))
+        except (KeyError, ValueError):
+            pass
+
+        # Retry-After (seconds) is sent with 429s, X-RateLimit-Reset is a unix
+        # timestamp of when the budget comes back.
+        try:
+            self.block(float(headers["Retry-After"]))
+        except (KeyError, ValueError):
+            pass
+        try:
+            if self.tokens < 1:
+                self.block(int(headers["X-RateLimit-Reset"]) - time.time())
+        except (KeyError, ValueError):
+            pass
+
+    def block(self, seconds):
+        """Stops handing out tokens for a while.
+
+        Keyword arguments:
+          seconds -- How long to block for.
+        """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def more_urgent(priority, other):
+    """Checks whether a priority class is more urgent than another.
+
+    Keyword arguments:
+      priority -- Priority class.
+      other -- Priority class compared to.
+    """
+    return PRIORITIES.index(priority) < PRIORITIES.index(other)
+
+
+def backoff(attempt):
+    """Returns how long to wait before retrying, with full jitter.
+
+    Keyword arguments:
+      attempt -- Number of the failed attempt (starting at 0).
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+limiter = RateLimiter()
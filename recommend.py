@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""
+Collaborative filtering recommendations over the local score index.
+"""
+
+import threading
+import numpy as np
+from scipy import sparse
+
+# How many of the most similar users a recommendation is based on.
+NEIGHBOURS = 30
+# How many neighbours need to have scored a title for it to be recommended.
+MIN_RATERS = 2
+
+
+class Recommender:
+    """User-based collaborative filtering on sparse mean-centered scores.
+
+    Rows are encoded per user and only re-encoded when the user's entries
+    change in the score index; the sparse matrices are reassembled from the
+    encoded rows with plain array concatenation.
+
+    Updates and recommendations are meant to run in an executor, and hold a
+    lock so a recommendation never sees a half updated model.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.version = None
+        self.rows = {}
+        self.columns = {}
+        self.media_ids = []
+        self.users = []
+        self.user_row = {}
+        self.centered = None
+        self.normalized = None
+        self.lock = threading.Lock()
+
+    def _encode(self, user_id):
+        media, scores = [], []
+        # Copied, the index may be synced while this runs in an executor.
+        for media_id in list(self.index.user_media.get(user_id, ())):
+            entry = self.index.get(media_id, user_id)
+            score = entry and entry["score"]
+            if score:
+                if media_id not in self.columns:
+                    self.columns[media_id] = len(self.media_ids)
+                    self.media_ids.append(media_id)
+                media.append(self.columns[media_id])
+                scores.append(score)
+
+        cols = np.array(media, dtype=np.int32)
+        centered = np.array(scores, dtype=np.float32)
+        mean = float(centered.mean()) if len(centered) else 0.0
+        centered -= mean
+        norm = np.linalg.norm(centered)
+        normalized = centered / norm if norm else centered
+        return self.index.versions.get(user_id), cols, centered, normalized, mean
+
+    def update(self):
+        """Re-encodes the users that changed since the last update."""
+        with self.lock:
+            self._update()
+
+    def _update(self):
+        if self.version == self.index.version:
+            return
+        version = self.index.version
+
+        for user_id in list(self.rows):
+            if user_id not in self.index.synced:
+                del self.rows[user_id]
+        for user_id in list(self.index.synced):
+            row = self.rows.get(user_id)
+            if row is None or row[0] != self.index.versions.get(user_id):
+                self.rows[user_id] = self._encode(user_id)
+
+        self.users = list(self.rows)
+        self.user_row = {user_id: i for i, user_id in enumerate(self.users)}
+        rows = [self.rows[user_id] for user_id in self.users]
+
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(row[1]) for row in rows])
+        shape = (len(rows), len(self.media_ids))
+
+        def assemble(part):
+            if not rows:
+                return sparse.csr_matrix(shape, dtype=np.float32)
+            return sparse.csr_matrix(
+                (
+                    np.concatenate([row[part] for row in rows]),
+                    np.concatenate([row[1] for row in rows]),
+                    indptr,
+                ),
+                shape=shape,
+            )
+
+        self.centered = assemble(2)
+        self.normalized = assemble(3)
+        self.version = version
+
+    def recommend(self, user_id, user_ids, count):
+        """Recommends titles to a user from the scores of similar users.
+
+        Returns a list of (media ID, predicted score) tuples, best first.
+        Titles already on the user's list are skipped.
+
+        Keyword arguments:
+          user_id -- AniList user ID.
+          user_ids -- AniList user IDs to base the recommendation on.
+          count -- How many titles to return.
+        """
+        with self.lock:
+            self._update()
+            return self._recommend(user_id, user_ids, count)
+
+    def _recommend(self, user_id, user_ids, count):
+        if user_id not in self.user_row:
+            return []
+
+        others = [
+            self.user_row[other]
+            for other in set(user_ids)
+            if other != user_id and other in self.user_row
+        ]
+        if not others:
+            return []
+
+        # Cosine similarity of mean-centered scores.
+        me = self.normalized[self.user_row[user_id]]
+        similarity = (self.normalized[others] @ me.T).toarray().ravel()
+
+        k = min(NEIGHBOURS, len(others))
+        best = np.argpartition(-similarity, k - 1)[:k]
+        best = best[similarity[best] > 0]
+        if not len(best):
+            return []
+
+        neighbours = self.centered[[others[i] for i in best]]
+        weights = similarity[best]
+
+        # Which neighbours scored each title (a score can center to 0).
+        rated = neighbours.copy()
+        rated.data = np.ones_like(rated.data)
+        raters = np.asarray(rated.sum(axis=0)).ravel()
+        weight_sums = rated.T @ weights
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            predicted = (neighbours.T @ weights) / weight_sums
+        predicted[(raters < MIN_RATERS) | ~(weight_sums > 0)] = -np.inf
+
+        seen = [
+            self.columns[media_id]
+            for media_id in list(self.index.user_media.get(user_id, ()))
+            if media_id in self.columns
+        ]
+        predicted[seen] = -np.inf
+
+        count = min(count, int(np.isfinite(predicted).sum()))
+        if count == 0:
+            return []
+        top = np.argpartition(-predicted, count - 1)[:count]
+        top = top[np.argsort(-predicted[top])]
+        mean = self.rows[user_id][4]
+        return [
+            (self.media_ids[i], min(100.0, max(0.0, mean + float(predicted[i]))))
+            for i in top
+        ]
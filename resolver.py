@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+Memoized name to AniList ID resolution.
+"""
+
+import re
+from cache import TTLCache
+import diskcache
+
+# How long resolved and unresolved names are remembered (seconds).
+NAME_TTL = 24 * 60 * 60
+MISSING_TTL = 5 * 60
+
+NOT_FOUND = object()
+
+names = TTLCache(max_entries=20000, max_bytes=4 * 1024 * 1024)
+missing = TTLCache(max_entries=5000, max_bytes=1024 * 1024)
+
+
+def normalize(namespace, name):
+    """Builds the memo key of a name.
+
+    Keyword arguments:
+      namespace -- Entity namespace (e.g. "Media:ANIME").
+      name -- Searched name.
+    """
+    return namespace + ":" + re.sub(r"\s+", " ", str(name)).strip().lower()
+
+
+def is_id(name):
+    """Checks whether a name should be looked up as an AniList ID.
+
+    Keyword arguments:
+      name -- Searched name.
+    """
+    return str(name).strip().isdigit()
+
+
+def lookup(namespace, name):
+    """Gets the ID a name resolved to.
+
+    Returns the ID, NOT_FOUND if the name recently failed to resolve,
+    or None if it is unknown.
+
+    Keyword arguments:
+      namespace -- Entity namespace.
+      name -- Searched name.
+    """
+    key = normalize(namespace, name)
+    entity_id = names.get(key)
+    if entity_id is not None:
+        return entity_id
+    if missing.get(key) is not None:
+        return NOT_FOUND
+
+    entity_id = diskcache.get_name(key)
+    if entity_id is not None:
+        names.set(key, entity_id, NAME_TTL)
+    return entity_id
+
+
+def remember(namespace, name, entity_id):
+    """Stores the ID a name resolved to.
+
+    Keyword arguments:
+      namespace -- Entity namespace.
+      name -- Searched name.
+      entity_id -- AniList ID.
+    """
+    key = normalize(namespace, name)
+    if names.peek(key) != entity_id:
+        diskcache.put_name(key, entity_id)
+    names.set(key, entity_id, NAME_TTL)
+
+
+def remember_missing(namespace, name):
+    """Stores that a name did not resolve.
+
+    Keyword arguments:
+      namespace -- Entity namespace.
+      name -- Searched name.
+    """
+    missing.set(normalize(namespace, name), True, MISSING_TTL)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""
+Local index of linked users' list entries, synced from AniList in the
+background.
+"""
+
+import asyncio
+import time
+import anilist
+import files
+import ratelimit
+from queries import QUERY_MEDIALIST_COLLECTIONS, medialist_delta_batch
+
+# How many users are fully synced at the same time.
+SYNC_CONCURRENCY = 4
+
+# How often a user's lists are fully re-downloaded, which also picks up
+# removed entries (seconds). Syncs in between only fetch changed entries.
+FULL_SYNC_INTERVAL = 24 * 60 * 60
+
+# Users per delta request, entries per user page, and how many pages of
+# changes are followed before falling back to a full sync.
+DELTA_CHUNK_SIZE = 20
+DELTA_PER_PAGE = 25
+DELTA_MAX_PAGES = 4
+
+
+class ScoreIndex:
+    """List entries keyed by (media ID, AniList user ID)."""
+
+    def __init__(self):
+        self.entries = {}
+        self.user_media = {}
+        self.synced = {}
+        self.high_water = {}
+        # Bumped on every change, so derived data knows which users changed.
+        self.version = 0
+        self.versions = {}
+
+    def get(self, media_id, user_id):
+        """Gets a user's entry on a media, or None if it's not on their list.
+
+        Keyword arguments:
+          media_id -- Media ID.
+          user_id -- AniList user ID.
+        """
+        return self.entries.get((media_id, user_id))
+
+    def is_synced(self, user_id):
+        """Checks whether a user's lists are in the index.
+
+        Keyword arguments:
+          user_id -- AniList user ID.
+        """
+        return user_id in self.synced
+
+    def replace_user(self, user_id, entries, synced_at, high_water):
+        """Replaces all of a user's entries.
+
+        Keyword arguments:
+          user_id -- AniList user ID.
+          entries -- List entry dictionaries.
+          synced_at -- Full sync time (unix time).
+          high_water -- Latest updatedAt of the user's entries.
+        """
+        self.remove_user(user_id)
+        self.user_media[user_id] = set()
+        self.update_user(user_id, entries, high_water)
+        self.synced[user_id] = synced_at
+
+    def update_user(self, user_id, entries, high_water):
+        """Adds or updates some of a user's entries.
+
+        Keyword arguments:
+          user_id -- AniList user ID.
+          entries -- Changed list entry dictionaries.
+          high_water -- Latest updatedAt of the user's entries.
+        """
+        media = self.user_media.setdefault(user_id, set())
+        for entry in entries:
+            self.entries[(entry["mediaId"], user_id)] = entry
+            media.add(entry["mediaId"])
+        self.high_water[user_id] = high_water
+        self.version += 1
+        self.versions[user_id] = self.version
+
+    def remove_user(self, user_id):
+        """Removes all of a user's entries.
+
+        Keyword arguments:
+          user_id -- AniList user ID.
+        """
+        for media_id in self.user_media.pop(user_id, ()):
+            del self.entries[(media_id, user_id)]
+        self.synced.pop(user_id, None)
+        self.high_water.pop(user_id, None)
+        self.versions.pop(user_id, None)
+        self.version += 1
+
+
+def collection_entries(collection):
+    """Flattens a MediaListCollection into unique entries.
+
+    Entries on custom lists show up more than once.
+
+    Keyword arguments:
+      collection -- MediaListCollection dictionary.
+    """
+    entries = {}
+    if collection:
+        for media_list in collection["lists"]:
+            for entry in media_list["entries"]:
+                entries[entry["mediaId"]] = entry
+    return list(entries.values())
+
+
+def load():
+    """Loads the index from the database."""
+    rows, syncs = files.load_list_entries()
+
+    grouped = {user_id: [] for user_id in syncs}
+    for user_id, entry in rows:
+        grouped.setdefault(user_id, []).append(entry)
+    for user_id, entries in grouped.items():
+        synced_at, high_water = syncs.get(user_id, (0, 0))
+        index.replace_user(user_id, entries, synced_at, high_water)
+
+
+def latest_update(entries, high_water=0):
+    """Gets the latest updatedAt of some entries.
+
+    Keyword arguments:
+      entries -- List entry dictionaries.
+      high_water -- Previous high-water mark.
+    """
+    return max([high_water] + [entry["updatedAt"] or 0 for entry in entries])
+
+
+async def sync_user(user_id):
+    """Pulls a user's full anime and manga lists into the index.
+
+    Keyword arguments:
+      user_id -- AniList user ID.
+    """
+    data = await anilist.post(
+        QUERY_MEDIALIST_COLLECTIONS, {"userId": user_id}, priority=ratelimit.BACKGROUND
+    )
+    entries = collection_entries(data["anime"]) + collection_entries(data["manga"])
+
+    synced_at = time.time()
+    high_water = latest_update(entries)
+    index.replace_user(user_id, entries, synced_at, high_water)
+    files.replace_list_entries(user_id, entries, synced_at, high_water)
+
+
+async def fetch_delta_chunk(user_pages):
+    """Gets a page of most recently updated entries for each of some users.
+
+    Keyword arguments:
+      user_pages -- (user ID, page) tuples.
+    """
+    query = medialist_delta_batch(user_pages, DELTA_PER_PAGE)
+    try:
+        data = await anilist.post(query, priority=ratelimit.BACKGROUND)
+    except Exception as e:
+        print(f"Delta sync request failed: {e!r}")
+        return {}
+    return {user_id: data.get(f"_{user_id}") for user_id, _ in user_pages}
+
+
+async def sync_deltas(user_ids):
+    """Applies the entries changed since each user's high-water mark.
+
+    Many users are batched into one aliased request. Users with no changes
+    cost a single small page, and are left as they are.
+
+    Keyword arguments:
+      user_ids -- AniList IDs of synced users.
+    """
+    pages = {user_id: 1 for user_id in user_ids}
+    changes = {user_id: [] for user_id in user_ids}
+    full = []
+
+    while pages:
+        user_pages = list(pages.items())
+        chunks = [
+            user_pages[i : i + DELTA_CHUNK_SIZE]
+            for i in range(0, len(user_pages), DELTA_CHUNK_SIZE)
+        ]
+        responses = await asyncio.gather(*(fetch_delta_chunk(i) for i in chunks))
+
+        next_pages = {}
+        for response in responses:
+            for user_id, page in response.items():
+                if page is None:
+                    continue
+                mark = index.high_water.get(user_id, 0)
+                # Entries updated in the same second as the mark may be new
+                # too, so entries are also compared with the stored ones.
+                recent = [
+                    entry
+                    for entry in page["mediaList"]
+                    if (entry["updatedAt"] or 0) >= mark
+                ]
+                changes[user_id] += [
+                    entry
+                    for entry in page["mediaList"]
+                    if (entry["updatedAt"] or 0) > mark
+                    or entry != index.get(entry["mediaId"], user_id)
+                ]
+
+                if len(recent) == len(page["mediaList"]) and page["pageInfo"][
+                    "hasNextPage"
+                ]:
+                    if pages[user_id] < DELTA_MAX_PAGES:
+                        next_pages[user_id] = pages[user_id] + 1
+                    else:
+                        full.append(user_id)
+        pages = next_pages
+
+    for user_id, entries in changes.items():
+        if entries and user_id not in full:
+            high_water = latest_update(entries, index.high_water.get(user_id, 0))
+            index.update_user(user_id, entries, high_water)
+            files.update_list_entries(user_id, entries, high_water)
+    return full
+
+
+def schedule(user_id):
+    """Syncs a user's lists in the background.
+
+    Keyword arguments:
+      user_id -- AniList user ID.
+    """
+
+    async def sync_one():
+        try:
+            await sync_user(user_id)
+        except Exception as e:
+            print(f"Syncing lists of {user_id} failed: {e!r}")
+
+    asyncio.ensure_future(sync_one())
+
+
+async def sync(user_ids):
+    """Syncs the lists of all the given users and drops everyone else.
+
+    Users that were never synced, or not fully synced for FULL_SYNC_INTERVAL,
+    are fully re-downloaded. Everyone else only gets their changed entries.
+
+    Keyword arguments:
+      user_ids -- AniList IDs of the linked users.
+    """
+    user_ids = set(user_ids)
+    for user_id in set(index.synced) - user_ids:
+        index.remove_user(user_id)
+        files.remove_list_entries(user_id)
+
+    now = time.time()
+    full = [
+        user_id
+        for user_id in user_ids
+        if now - index.synced.get(user_id, 0) > FULL_SYNC_INTERVAL
+    ]
+    full += await sync_deltas(user_ids - set(full))
+
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+    async def sync_one(user_id):
+        async with semaphore:
+            try:
+                await sync_user(user_id)
+            except Exception as e:
+                print(f"Syncing lists of {user_id} failed: {e!r}")
+
+    await asyncio.gather(*(sync_one(user_id) for user_id in full))
+
+
+index = ScoreIndex()
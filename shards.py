@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+Runs the bot as several worker processes that split the gateway shards.
+
+The launcher serves the shared AniList cache and rate limit tier (tier.py)
+and keeps the workers running. Workers share the SQLite databases, so run it
+from the bot's directory:
+
+    python shards.py --workers 4 --shards 8
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+
+import tier
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Discord allows one shard to connect every 5 seconds, so workers start
+# staggered by this much per shard (seconds).
+IDENTIFY_DELAY = 5
+
+# How long to wait before restarting a worker that exited (seconds).
+RESTART_DELAY = 10
+
+
+def worker_shards(worker, workers, shard_count):
+    """Gets the shards run by a worker.
+
+    Keyword arguments:
+      worker -- Worker index.
+      workers -- Worker count.
+      shard_count -- Total shard count.
+    """
+    return list(range(worker, shard_count, workers))
+
+
+async def run_worker(worker, shard_ids, shard_count, address, delay, processes):
+    """Runs a worker process, restarting it whenever it exits.
+
+    Keyword arguments:
+      worker -- Worker index.
+      shard_ids -- Shards run by the worker.
+      shard_count -- Total shard count.
+      address -- Address of the tier.
+      delay -- How long to wait before the first start (seconds).
+      processes -- Running processes, by worker index.
+    """
+    env = dict(
+        os.environ,
+        ANICHAN_SHARD_IDS=",".join(map(str, shard_ids)),
+        ANICHAN_SHARD_COUNT=str(shard_count),
+        ANICHAN_WORKER=str(worker),
+        ANICHAN_TIER=address,
+    )
+    await asyncio.sleep(delay)
+    while True:
+        print(f"Starting worker {worker} with shards {shard_ids}")
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(ROOT, "main.py"), env=env
+        )
+        processes[worker] = process
+        code = await process.wait()
+        print(f"Worker {worker} exited ({code}), restarting in {RESTART_DELAY}s.")
+        await asyncio.sleep(RESTART_DELAY)
+
+
+async def launch(args):
+    """Serves the tier and runs the workers until interrupted."""
+    server = await tier.serve(args.tier)
+    print(f"Cache tier listening on {args.tier}")
+
+    processes = {}
+    shard_count = max(args.shards, args.workers)
+    delay = 0
+    runners = []
+    for worker in range(args.workers):
+        shard_ids = worker_shards(worker, args.workers, shard_count)
+        runners.append(
+            run_worker(worker, shard_ids, shard_count, args.tier, delay, processes)
+        )
+        delay += IDENTIFY_DELAY * len(shard_ids)
+
+    try:
+        await asyncio.gather(*runners)
+    finally:
+        for process in processes.values():
+            if process.returncode is None:
+                process.terminate()
+        for process in processes.values():
+            await process.wait()
+        server.close()
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shards", type=int, default=0, help="total shard count")
+    parser.add_argument("--tier", default=tier.DEFAULT_ADDRESS, help="host:port")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    task = asyncio.ensure_future(launch(parse_args()))
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+    finally:
+        loop.close()
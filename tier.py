@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""
+AniList response cache and rate limiter shared by the bot's worker processes.
+
+The launcher (shards.py) serves the tier on a local socket and the workers
+connect to it. Responses fetched by one worker are then cached for all of
+them, and all workers spend one AniList rate limit budget. Workers fall back
+to their own cache and limiter while the tier is unreachable.
+"""
+
+import asyncio
+import itertools
+import json
+import time
+import cache
+import ratelimit
+
+DEFAULT_ADDRESS = "127.0.0.1:8766"
+
+# How long requests wait for an answer, except for rate limit tokens (seconds).
+REQUEST_TIMEOUT = 2
+# How long to wait before reconnecting after losing the tier (seconds).
+RECONNECT_INTERVAL = 5
+
+# Longest message, a whole cached response (bytes).
+MAX_MESSAGE = 16 * 1024 * 1024
+
+# Rate limit headers forwarded to the tier.
+HEADERS = (
+    "X-RateLimit-Limit",
+    "X-RateLimit-Remaining",
+    "X-RateLimit-Reset",
+    "Retry-After",
+)
+
+client = None
+
+
+def parse_address(address):
+    """Splits a "host:port" address.
+
+    Keyword arguments:
+      address -- Tier address.
+    """
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+class TierServer:
+    """Serves the shared cache and rate limiter over newline delimited JSON.
+
+    Requests are {"id", "op", ...} objects, answered with {"id", "result"}.
+    """
+
+    def __init__(self):
+        self.responses = cache.TTLCache()
+        self.limiter = ratelimit.RateLimiter()
+
+    async def handle(self, reader, writer):
+        # Requests still being answered, so a worker that goes away doesn't
+        # leave rate limit waiters behind to take tokens for nobody.
+        answering = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(self.answer(json.loads(line), writer))
+                answering.add(task)
+                task.add_done_callback(answering.discard)
+        except (OSError, ValueError) as e:
+            print(f"Lost a tier worker: {e!r}")
+        finally:
+            for task in answering:
+                task.cancel()
+            writer.close()
+
+    async def answer(self, request, writer):
+        try:
+            result = await self.execute(request)
+        except Exception as e:
+            print(f"Tier request {request.get('op')} failed: {e!r}")
+            result = None
+        if not writer.is_closing():
+            response = {"id": request["id"], "result": result}
+            writer.write(json.dumps(response).encode() + b"\n")
+
+    async def execute(self, request):
+        op = request["op"]
+        if op == "get":
+            return self.responses.get(request["key"])
+        if op == "set":
+            self.responses.set(request["key"], request["value"], request["ttl"])
+            return None
+        if op == "acquire":
+            await self.limiter.acquire(request.get("priority", ratelimit.INTERACTIVE))
+            return self.limiter.remaining()
+        if op == "update":
+            self.limiter.update(request["headers"])
+            return self.limiter.remaining()
+        if op == "stats":
+            return self.responses.stats()
+        raise ValueError(f"Unknown op {op}")
+
+
+async def serve(address=DEFAULT_ADDRESS):
+    """Starts serving the tier.
+
+    Keyword arguments:
+      address -- "host:port" to listen on.
+    """
+    host, port = parse_address(address)
+    return await asyncio.start_server(
+        TierServer().handle, host, port, limit=MAX_MESSAGE
+    )
+
+
+class TierClient:
+    """Connection to the tier, shared by all requests of a worker."""
+
+    def __init__(self, address):
+        self.address = address
+        self.writer = None
+        self.pending = {}
+        self.ids = itertools.count()
+        self.retry_at = 0
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        """Connects to the tier, raising OSError if it's unreachable."""
+        host, port = parse_address(self.address)
+        reader, self.writer = await asyncio.open_connection(
+            host, port, limit=MAX_MESSAGE
+        )
+        asyncio.ensure_future(self._read(reader))
+
+    async def _read(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self.pending.pop(response["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(response["result"])
+        except (OSError, ValueError) as e:
+            print(f"Lost the cache tier: {e!r}")
+        finally:
+            self.writer = None
+            self.retry_at = time.monotonic() + RECONNECT_INTERVAL
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost the cache tier"))
+            self.pending.clear()
+
+    async def request(self, op, timeout=REQUEST_TIMEOUT, **kwargs):
+        """Sends a request and waits for its result.
+
+        Raises ConnectionError or asyncio.TimeoutError when the tier can't
+        answer.
+
+        Keyword arguments:
+          op -- Operation.
+          timeout -- How long to wait for the result (seconds), None for ever.
+          **kwargs -- Operation arguments.
+        """
+        if not self.connected:
+            if time.monotonic() < self.retry_at:
+                raise ConnectionError("The cache tier is unreachable")
+            try:
+                await self.connect()
+            except OSError as e:
+                self.retry_at = time.monotonic() + RECONNECT_INTERVAL
+                raise ConnectionError("The cache tier is unreachable") from e
+
+        id = next(self.ids)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[id] = future
+        self.writer.write(json.dumps(dict(kwargs, id=id, op=op)).encode() + b"\n")
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(id, None)
+
+
+class SharedLimiter:
+    """Rate limiter spending the tier's budget, with a local fallback."""
+
+    def __init__(self, client, fallback):
+        self.client = client
+        self.fallback = fallback
+        self.last_remaining = None
+
+    def remaining(self):
+        """Returns the request budget left, as of the last tier answer."""
+        if self.client.connected and self.last_remaining is not None:
+            return self.last_remaining
+        return self.fallback.remaining()
+
+    async def acquire(self, priority=ratelimit.INTERACTIVE):
+        """Waits until a request may be sent and takes a token for it.
+
+        Keyword arguments:
+          priority -- Priority class (see ratelimit.PRIORITIES).
+        """
+        try:
+            self.last_remaining = await self.client.request(
+                "acquire", timeout=None, priority=priority
+            )
+        except ConnectionError:
+            await self.fallback.acquire(priority)
+
+    def update(self, headers):
+        """Corrects the shared and local budgets using the headers of a response.
+
+        Keyword arguments:
+          headers -- Response headers.
+        """
+        self.fallback.update(headers)
+        headers = {name: headers[name] for name in HEADERS if name in headers}
+        asyncio.ensure_future(self._update(headers))
+
+    async def _update(self, headers):
+        try:
+            self.last_remaining = await self.client.request("update", headers=headers)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+
+
+async def connect(address):
+    """Uses the tier for this process's cache and rate limiter.
+
+    Keyword arguments:
+      address -- "host:port" of the tier.
+    """
+    global client
+
+    client = TierClient(address)
+    try:
+        await client.connect()
+    except OSError as e:
+        client.retry_at = time.monotonic() + RECONNECT_INTERVAL
+        print(f"Cache tier at {address} is unreachable ({e!r}), retrying later.")
+    ratelimit.limiter = SharedLimiter(client, ratelimit.limiter)
+
+
+async def get(key):
+    """Gets a cached response from the tier, or None.
+
+    Keyword arguments:
+      key -- Cache key.
+    """
+    if client is None:
+        return None
+    try:
+        return await client.request("get", key=key)
+    except (ConnectionError, asyncio.TimeoutError):
+        return None
+
+
+def store(key, value, ttl):
+    """Caches a response in the tier in the background.
+
+    Keyword arguments:
+      key -- Cache key.
+      value -- Response data.
+      ttl -- Time to live (seconds).
+    """
+    if client is None:
+        return
+
+    async def send():
+        try:
+            await client.request("set", key=key, value=value, ttl=ttl)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+
+    asyncio.ensure_future(send())
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+"""
+Local index of media titles, filled by a background crawl of the AniList
+catalogue.
+
+English, romaji and native titles and synonyms are matched exactly, by
+prefix and by trigram similarity, so searches and name lookups are answered
+without a request. The names and their trigram index (SQLite FTS5) are kept
+in cache.db, shared by every worker process. Lookups run in an executor, and
+the index is off where SQLite has no trigram tokenizer (before 3.34).
+"""
+
+import asyncio
+import re
+import time
+import unicodedata
+import anilist
+import cache
+import diskcache
+import ratelimit
+from queries import QUERY_CATALOGUE
+
+CRAWL = "titles"
+
+# Media per crawl request (AniList allows up to 50).
+CRAWL_PER_PAGE = 50
+# How often a crawl page is requested (seconds). Crawl requests are
+# background requests, so they also wait while the rate limit budget is low.
+CRAWL_INTERVAL = 5
+# How long after a finished pass the catalogue is crawled again (seconds).
+RECRAWL_AFTER = 24 * 60 * 60
+
+# Lowest similarity of a fuzzy result, and of a fuzzy result trusted as the
+# answer to a name lookup.
+MIN_SIMILARITY = 0.3
+MATCH_SIMILARITY = 0.6
+
+# How many names of each kind of candidate (substring and trigram matches)
+# are scored for a query, and how many of the query's rarest trigrams pick
+# the trigram matches.
+CANDIDATES = 200
+RAREST_TRIGRAMS = 4
+
+# How many recent lookups keep their scores, and for how long (seconds), so
+# a command scores a query once.
+SCORED_ENTRIES = 256
+SCORED_TTL = 60
+
+# Scores of exact and prefix matches, above any similarity.
+EXACT = 3
+PREFIX = 2
+WORD_PREFIX = 1
+
+
+def normalize(name):
+    """Folds case, width and punctuation out of a title.
+
+    Keyword arguments:
+      name -- Title.
+    """
+    name = unicodedata.normalize("NFKC", name).casefold()
+    return " ".join(re.sub(r"[\W_]+", " ", name).split())
+
+
+def trigrams(name):
+    """Gets the trigrams of a normalized title, padded to weigh its start.
+
+    Keyword arguments:
+      name -- Normalized title.
+    """
+    padded = f"  {name} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def record(media):
+    """Gets the index record of a media from a catalogue page.
+
+    Keyword arguments:
+      media -- Media dictionary.
+    """
+    return {
+        "id": media["id"],
+        "type": media["type"],
+        "title": media["title"],
+        "synonyms": media.get("synonyms") or [],
+        "popularity": media.get("popularity") or 0,
+    }
+
+
+def names(record):
+    """Gets the normalized names of an index record.
+
+    Keyword arguments:
+      record -- Index record (see record()).
+    """
+    title = record["title"]
+    return {
+        normalize(name)
+        for name in [title["english"], title["romaji"], title["native"]]
+        + record["synonyms"]
+        if name
+    } - {""}
+
+
+class TitleIndex:
+    """Media titles searchable by prefix and trigram similarity.
+
+    Only the crawl progress is kept in memory. Lookups query the names in
+    cache.db, whose trigram index preselects the candidates that get scored.
+    They block on SQLite, so they are run in an executor (see the module
+    functions).
+    """
+
+    def __init__(self):
+        self.cursor = 0
+        self.finished_at = None
+
+    @property
+    def complete(self):
+        """Whether the whole catalogue was crawled at least once."""
+        return self.finished_at is not None
+
+    def add(self, records):
+        """Adds or replaces some media.
+
+        Keyword arguments:
+          records -- Index records (see record()).
+        """
+        diskcache.put_titles(
+            records,
+            [
+                (record["id"], name, record["type"], record["popularity"])
+                for record in records
+                for name in names(record)
+            ],
+        )
+
+    def exact(self, query, media_type):
+        """Gets the most popular media with a name, or None.
+
+        Keyword arguments:
+          query -- Searched title.
+          media_type -- Media type.
+        """
+        found = diskcache.get_title_ids(normalize(query), media_type)
+        return max(found, key=lambda i: i[1])[0] if found else None
+
+    def scores(self, query, media_type=None):
+        """Scores the media matching a query, by their best matching name.
+
+        Returns a list of (media ID, score, popularity) tuples, best and most
+        popular first.
+
+        Keyword arguments:
+          query -- Searched title.
+          media_type -- Media type, None for all.
+        """
+        query = normalize(query)
+        # Shorter queries have no trigram to look up.
+        if len(query) < 3:
+            return []
+
+        # Names containing the query, and names sharing its rarest trigrams.
+        candidates = diskcache.like_title_names(f"%{query}%", media_type, CANDIDATES)
+        counts = diskcache.count_trigrams(
+            {query[i : i + 3] for i in range(len(query) - 2)}
+        )
+        rarest = sorted(counts, key=counts.get)[:RAREST_TRIGRAMS]
+        if rarest:
+            match = " OR ".join(f'"{gram}"' for gram in rarest)
+            candidates += diskcache.match_title_names(match, media_type, CANDIDATES)
+
+        grams = trigrams(query)
+        result = {}
+        for name, media_id, popularity in candidates:
+            if name == query:
+                score = EXACT
+            elif name.startswith(query):
+                score = PREFIX + len(query) / len(name)
+            elif f" {query}" in f" {name}":
+                score = WORD_PREFIX + len(query) / len(name)
+            else:
+                name_grams = trigrams(name)
+                score = 2 * len(grams & name_grams) / (len(grams) + len(name_grams))
+                if score < MIN_SIMILARITY:
+                    continue
+            if score > result.get(media_id, (0, 0))[0]:
+                result[media_id] = (score, popularity)
+        best = sorted(result, key=result.get, reverse=True)
+        return [(media_id, *result[media_id]) for media_id in best]
+
+    def records(self, ids):
+        """Gets the records of some media, in the same order.
+
+        Keyword arguments:
+          ids -- Media IDs.
+        """
+        records = diskcache.get_titles(ids)
+        return [records[i] for i in ids if i in records]
+
+    def stats(self):
+        """Returns a dictionary of index statistics."""
+        if not available():
+            return {"available": False}
+        media, name_count = diskcache.count_titles()
+        return {"media": media, "names": name_count, "complete": self.complete}
+
+
+index = TitleIndex()
+scored = cache.TTLCache(max_entries=SCORED_ENTRIES)
+
+
+def available():
+    """Checks whether the title index can be kept on this SQLite."""
+    return diskcache.has_title_index()
+
+
+async def run(function, *args):
+    """Runs an index lookup in an executor.
+
+    Keyword arguments:
+      function -- Lookup function.
+      *args -- Its arguments.
+    """
+    return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+
+async def scores(query, media_type=None):
+    """Scores the media matching a query (see TitleIndex.scores), reusing the
+    scores of a recent lookup of the same query.
+
+    Keyword arguments:
+      query -- Searched title.
+      media_type -- Media type, None for all.
+    """
+    key = (normalize(query), media_type)
+    result = scored.get(key)
+    if result is None:
+        result = await run(index.scores, query, media_type)
+        scored.set(key, result, SCORED_TTL)
+    return result
+
+
+async def search(query, media_type=None, limit=25):
+    """Gets the media best matching a query, best and most popular first.
+
+    Keyword arguments:
+      query -- Searched title.
+      media_type -- Media type, None for all.
+      limit -- Most media returned.
+    """
+    if not available():
+        return []
+    best = (await scores(query, media_type))[:limit]
+    if not best:
+        return []
+    return await run(index.records, [media_id for media_id, _, _ in best])
+
+
+async def match(query, media_type):
+    """Gets the ID of the media a name lookup means, or None if it's not clear
+    without asking AniList.
+
+    Exact title matches are trusted as soon as they are indexed. Other matches
+    only once the whole catalogue is indexed.
+
+    Keyword arguments:
+      query -- Searched title.
+      media_type -- Media type.
+    """
+    if not available():
+        return None
+    media_id = await run(index.exact, query, media_type)
+    if media_id is not None or not index.complete:
+        return media_id
+
+    best = await scores(query, media_type)
+    if best and best[0][1] >= MATCH_SIMILARITY:
+        return best[0][0]
+    return None
+
+
+def load():
+    """Loads the crawl progress, which may come from another process."""
+    if available():
+        index.cursor, index.finished_at = diskcache.get_crawl(CRAWL)
+
+
+async def crawl():
+    """Indexes the next page of the catalogue.
+
+    Waits for the next pass once the catalogue was crawled.
+    """
+    if not available():
+        return
+    if index.cursor == 0 and index.finished_at is not None:
+        if time.time() - index.finished_at < RECRAWL_AFTER:
+            return
+
+    try:
+        data = await anilist.post(
+            QUERY_CATALOGUE,
+            {"after": index.cursor, "perPage": CRAWL_PER_PAGE},
+            priority=ratelimit.BACKGROUND,
+        )
+    except Exception as e:
+        print(f"Title crawl request failed: {e!r}")
+        return
+
+    records = [record(media) for media in data["Page"]["media"]]
+    index.add(records)
+
+    if data["Page"]["pageInfo"]["hasNextPage"] and records:
+        index.cursor = records[-1]["id"]
+    else:
+        index.cursor = 0
+        index.finished_at = time.time()
+        print(f"Title index crawled: {index.stats()['media']} media")
+    diskcache.put_crawl(CRAWL, index.cursor, index.finished_at)